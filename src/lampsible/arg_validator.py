@@ -3,8 +3,8 @@ from re import match
 from copy import deepcopy
 from getpass import getpass, getuser
 from textwrap import dedent
-from requests import head as requests_head
 from lampsible.constants import *
+from lampsible.version_index import VersionIndex
 
 
 class ArgValidator():
@@ -12,6 +12,7 @@ class ArgValidator():
     def __init__(self, args):
         self.args           = args
         self.validated_args = deepcopy(args)
+        self.version_index  = None
 
 
     def get_validated_args(self):
@@ -107,21 +108,24 @@ class ArgValidator():
             return password
 
 
-    def validate_ansible_runner_args(self):
+    def split_web_user_host(self, web_user_host):
+        """Splits a single 'user@host' string into a tuple (user, host).
+        The user may be omitted if the host is localhost.
+        Prints an error and returns None if the input is invalid.
+        """
         try:
-            web_user_host = self.args.web_user_host.split('@')
-            assert len(web_user_host) <= 2
-            self.validated_args.web_user = web_user_host[0]
-            self.validated_args.web_host = web_user_host[1]
+            user_host = web_user_host.strip().split('@')
+            assert len(user_host) <= 2
+            web_user = user_host[0]
+            web_host = user_host[1]
         except AssertionError:
             print("FATAL! First positional argument is invalid.")
-            return 1
+            return None
         except IndexError:
-            self.validated_args.web_host = self.validated_args.web_user
+            web_host = user_host[0]
             try:
-                assert self.validated_args.web_host in ['localhost',
-                    '127.0.0.1']
-                self.validated_args.web_user = getuser()
+                assert web_host in ['localhost', '127.0.0.1']
+                web_user = getuser()
             except AssertionError:
                 print(dedent(
                     """
@@ -131,35 +135,62 @@ class ArgValidator():
                     'user@host'.
                     """
                     ))
-                return 1
+                return None
+
+        if web_host in ['localhost', '127.0.0.1']:
+            web_user = getuser()
+            if '@' in web_user_host:
+                print(dedent(
+                    """
+                    Warning! The 'user' in 'user@localhost' will be ignored,
+                    and replaced by current running user ({}). When running
+                    locally, it's enough to just pass in
+                    'localhost' or '127.0.0.1'.
+                    """.format(web_user)
+                ))
+            self.args.ask_remote_sudo = os.geteuid() != 0
+
+        return (web_user, web_host)
+
+
+    def validate_ansible_runner_args(self):
+        try:
+            web_user_hosts = [
+                self.split_web_user_host(web_user_host)
+                for web_user_host in self.args.web_user_host.split(',')
+            ]
         except AttributeError:
             print(dedent(
                 """
                 FATAL! First positional argument must be in the format of
                 'user@host', or if running directly on your web host,
                 it needs to be one of 'localhost' or '127.0.0.1'.
+                You can also pass a comma separated list of hosts,
+                like 'user@host1,user@host2'.
                 """
                 ))
             return 1
+        if None in web_user_hosts:
+            return 1
+        if len(set([user for user, host in web_user_hosts])) > 1:
+            print('FATAL! All web hosts must share the same user.')
+            return 1
 
-        if self.validated_args.web_host in ['localhost', '127.0.0.1']:
-            self.validated_args.web_user = getuser()
-            if '@' in self.args.web_user_host:
-                print(dedent(
-                    """
-                    Warning! The 'user' in 'user@localhost' will be ignored,
-                    and replaced by current running user ({}). When running
-                    locally, it's enough to just pass in
-                    'localhost' or '127.0.0.1'.
-                    """.format(self.validated_args.web_user)
-                ))
-            self.args.ask_remote_sudo = os.geteuid() != 0
+        self.validated_args.web_user  = web_user_hosts[0][0]
+        self.validated_args.web_hosts = [host for user, host in web_user_hosts]
+        self.validated_args.web_host  = self.validated_args.web_hosts[0]
 
         if self.args.database_system_user_host:
             try:
-                db_sys_split = self.args.database_system_user_host.split('@')
-                self.validated_args.database_system_user = db_sys_split[0]
-                self.validated_args.database_system_host = db_sys_split[1]
+                db_sys_split = [
+                    user_host.strip().split('@')
+                    for user_host in self.args.database_system_user_host.split(',')
+                ]
+                assert len(set([user_host[0] for user_host in db_sys_split])) == 1
+                self.validated_args.database_system_user = db_sys_split[0][0]
+                self.validated_args.database_system_hosts = [
+                    user_host[1] for user_host in db_sys_split
+                ]
             except IndexError:
                 print(dedent("""
                     FATAL! --database-system-user-host must be in the format of 'user@host'.
@@ -168,10 +199,15 @@ class ArgValidator():
                     )
                 )
                 return 1
+            except AssertionError:
+                print('FATAL! All database hosts must share the same user.')
+                return 1
         else:
             # TODO: This is already taken care of in the Lampsible constructor.
             self.validated_args.database_system_user = self.validated_args.web_user
-            self.validated_args.database_system_host = self.validated_args.web_host
+            self.validated_args.database_system_hosts = self.validated_args.web_hosts
+        self.validated_args.database_system_host = \
+            self.validated_args.database_system_hosts[0]
 
         if self.args.action not in SUPPORTED_ACTIONS:
             print(dedent("""
@@ -185,6 +221,30 @@ class ArgValidator():
             and not self.args.insecure_cli_password:
             print(INSECURE_CLI_PASS_WARNING)
             return 1
+        if self.args.forks is not None and self.args.forks < 1:
+            print('FATAL! --forks must be a positive number.')
+            return 1
+
+        if not match(r"^[0-9]+%?$", self.args.serial):
+            print(dedent("""
+                FATAL! --serial must be a number of hosts, like '5',
+                or a percentage of hosts, like '25%'.
+                """
+            ))
+            return 1
+
+        if not match(r"^[0-9]+[smh]?$", self.args.ssh_control_persist):
+            print(dedent("""
+                FATAL! --ssh-control-persist must be a duration,
+                like '60', '60s', '10m' or '1h'.
+                """
+            ))
+            return 1
+
+        if self.args.ssh_timeout < 1:
+            print('FATAL! --ssh-timeout must be a positive number.')
+            return 1
+
         if self.args.ask_remote_sudo:
             self.validated_args.remote_sudo_password = self.get_pass_and_check(
                 'Please enter sudo password for web host: ')
@@ -295,6 +355,18 @@ class ArgValidator():
             print('Got invalid PHP version!')
             return 1
 
+        if self.args.php_fpm_max_children is not None \
+                and self.args.php_fpm_max_children < 1:
+            print('FATAL! --php-fpm-max-children must be at least 1.')
+            return 1
+        if self.args.php_fpm_max_requests < 0:
+            print('FATAL! --php-fpm-max-requests must not be negative.')
+            return 1
+        if self.args.php_opcache_jit and self.args.php_version \
+                and float(self.args.php_version) < 8.0:
+            print('FATAL! --php-opcache-jit requires minimum PHP version 8.0!')
+            return 1
+
         # TODO: A little redundant maybe because the Lampsible class now does something similar.
         # Based on the action, it appends anything else that it might need.
         # But this is still needed as well.
@@ -337,6 +409,13 @@ class ArgValidator():
             print('\nInvalid WordPress version! Leave --wordpress-version blank to default to \'{}\''.format(DEFAULT_WORDPRESS_VERSION))
             return 1
 
+        # Each web server would have a cache of its own, and they would
+        # get out of sync.
+        if self.args.wordpress_object_cache \
+                and len(self.validated_args.web_hosts) > 1:
+            print('FATAL! --wordpress-object-cache only works with a single web server.')
+            return 1
+
         self.handle_defaults([
             {
                 'arg_name': 'site_title',
@@ -370,24 +449,25 @@ class ArgValidator():
         return 0
 
 
-    def is_valid_wordpress_version(self, wp_version):
-        if wp_version in RECENT_WORDPRESS_VERSIONS:
-            return True
+    def get_version_index(self):
+        if self.version_index is None:
+            self.version_index = VersionIndex()
+        return self.version_index
 
-        try:
-            r = requests_head(
-                'https://wordpress.org/wordpress-{}.tar.gz'.format(wp_version)
-            )
-            assert r.status_code == 200
-            return True
-        except AssertionError:
-            return False
+
+    def is_valid_wordpress_version(self, wp_version):
+        return self.get_version_index().is_valid_wordpress_version(wp_version)
 
 
     def validate_joomla_args(self):
         if self.args.action != 'joomla':
             return 0
 
+        if not self.get_version_index().is_valid_joomla_version(
+                self.args.joomla_version):
+            print('\nInvalid Joomla version! Leave --joomla-version blank to default to \'{}\''.format(DEFAULT_JOOMLA_VERSION))
+            return 1
+
         if self.validated_args.php_version:
             if int(self.args.joomla_version[0]) >= 5 \
                     and float(self.validated_args.php_version) < 8.1:
@@ -535,6 +615,24 @@ class ArgValidator():
         except AttributeError:
             pass
 
+        if self.args.page_cache \
+                and self.args.action not in PAGE_CACHE_ACTIONS:
+            print('FATAL! --page-cache only works with the actions {}.'.format(
+                ', '.join(PAGE_CACHE_ACTIONS)))
+            return 1
+        if self.args.page_cache_ttl < 1:
+            print('FATAL! --page-cache-ttl must be at least 1.')
+            return 1
+
+        if self.args.profile_compare:
+            if not self.args.profile:
+                print('FATAL! --profile-compare requires --profile.')
+                return 1
+            if not os.path.isfile(self.args.profile_compare):
+                print('FATAL! Profiling report {} not found.'.format(
+                    self.args.profile_compare))
+                return 1
+
         return 0
 
 
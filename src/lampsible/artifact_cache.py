@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+from threading import Lock
+from time import time
+from lampsible.constants import *
+
+
+# Several Lampsible objects might fetch the same artifact at the same time,
+# see run_many.
+_artifact_lock = Lock()
+
+
+def _hash_file(path, algorithm):
+    file_hash = hashlib.new(algorithm)
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ArtifactCache():
+    """Downloads artifacts, like WP-CLI or the WordPress and Joomla packages,
+    once, onto the controller, so that they can be pushed to any number of
+    hosts, instead of each host downloading them itself.
+
+    If upstream publishes a checksum, like WordPress does, the download
+    is verified against it. Each artifact is stored along with a small JSON
+    file holding its SHA-256 checksum, size, URL and when it was fetched,
+    and the checksum is verified again, whenever the artifact is reused.
+    Artifacts with a fixed version never expire, moving ones, like 'latest',
+    are fetched again after ttl seconds. If an artifact can't be fetched,
+    a stale copy is used, if there is one, otherwise the hosts download
+    it themselves.
+    """
+
+    def __init__(self, path=DEFAULT_ARTIFACT_CACHE_DIR,
+            ttl=DEFAULT_ARTIFACT_TTL,
+            timeout=DEFAULT_ARTIFACT_TIMEOUT):
+        self.path    = path
+        self.ttl     = ttl
+        self.timeout = timeout
+
+
+    def get(self, name, url, moving=False, checksum='', fetch=True):
+        """Returns a dict describing the artifact, which the roles use as is:
+        'name', 'url' and 'checksum' are always set, and 'src' is the path
+        of the artifact on the controller, or empty, if the artifact is not
+        available on the controller. checksum is in the format of
+        get_url's 'checksum', like 'sha1:https://...', or empty.
+        Unless fetch is True, only an artifact that's already cached is used,
+        even if it's stale.
+        """
+        artifact = {'name': name, 'url': url, 'checksum': checksum, 'src': ''}
+        with _artifact_lock:
+            meta = self._get_meta(name)
+            if meta and not (fetch and moving
+                    and time() - meta['fetched'] > self.ttl):
+                return dict(artifact, src=meta['src'])
+            if not fetch:
+                return artifact
+            try:
+                meta = self._fetch(name, url, checksum)
+            except Exception as e:
+                print('Warning! Could not fetch {}: {}'.format(url, e))
+                if not meta:
+                    return artifact
+        return dict(artifact, src=meta['src'])
+
+
+    def _get_meta(self, name):
+        src = os.path.join(self.path, name)
+        try:
+            with open(src + '.json', 'r') as stream:
+                meta = json.load(stream)
+            assert os.path.getsize(src) == meta['size']
+            assert _hash_file(src, 'sha256') == meta['sha256']
+            meta['src'] = src
+            return meta
+        except (OSError, ValueError, KeyError, AssertionError):
+            return None
+
+
+    def _fetch(self, name, url, checksum=''):
+        # Imported here, because it's slow to import.
+        import requests
+        if checksum:
+            algorithm, expected = checksum.split(':', 1)
+            if expected.startswith(('https://', 'http://')):
+                response = requests.get(expected, timeout=self.timeout)
+                response.raise_for_status()
+                # Might be followed by the file name, like sha1sum's output.
+                expected = response.text.split()[0]
+            upstream_hash = hashlib.new(algorithm)
+        os.makedirs(self.path, exist_ok=True)
+        src      = os.path.join(self.path, name)
+        tmp_path = '{}.{}.tmp'.format(src, os.getpid())
+        local_hash = hashlib.sha256()
+        size       = 0
+        try:
+            with requests.get(url, stream=True, timeout=self.timeout) \
+                    as response:
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as stream:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        local_hash.update(chunk)
+                        if checksum:
+                            upstream_hash.update(chunk)
+                        size += len(chunk)
+                        stream.write(chunk)
+            if checksum and upstream_hash.hexdigest() != expected.lower():
+                raise ValueError('{} checksum mismatch'.format(algorithm))
+            os.replace(tmp_path, src)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        meta = {
+            'url':     url,
+            'sha256':  local_hash.hexdigest(),
+            'size':    size,
+            'fetched': time(),
+        }
+        with open(src + '.json', 'w') as stream:
+            json.dump(meta, stream, indent=4, sort_keys=True)
+        meta['src'] = src
+        return meta
+
+
+def get_wordpress_artifact_source(version, locale):
+    """Returns the file name and URL of the WordPress package, whether
+    it's a moving target, and the checksum that WordPress publishes
+    alongside it, see ArtifactCache.get. The URL is picked the same way
+    as WP-CLI's 'core download' does it. Returns None for nightly builds,
+    which are left to WP-CLI.
+    """
+    if version == 'nightly':
+        return None
+    moving = version == 'latest'
+    if locale == 'en_US':
+        name = 'wordpress-{}.tar.gz'.format(version)
+        url  = 'https://wordpress.org/{}.tar.gz'.format(
+            'latest' if moving else 'wordpress-' + version)
+    else:
+        name = 'wordpress-{}-{}.tar.gz'.format(version, locale)
+        # Like WP-CLI, don't guess a subdomain like 'de.wordpress.org'
+        # from the locale, which breaks for locales like pt_BR or de_CH.
+        url  = 'https://downloads.wordpress.org/release/{}/{}.tar.gz'.format(
+            locale,
+            'latest' if moving else 'wordpress-' + version
+        )
+    return name, url, moving, 'sha1:{}.sha1'.format(url)
+
+
+def get_joomla_artifact_source(version):
+    dashed_version = version.replace('.', '-')
+    return (
+        'Joomla_{}-Stable-Full_Package.tar.gz'.format(dashed_version),
+        JOOMLA_DOWNLOAD_URL.format(
+            major=version.split('.')[0],
+            version=dashed_version
+        ),
+        False,
+        # Joomla doesn't publish a checksum file next to its packages.
+        ''
+    )
@@ -0,0 +1,155 @@
+from math import ceil
+from lampsible.constants import *
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def get_capacity_plan(memtotal_mb, vcpus, action, web=True, database=False,
+        php=True, php_fpm=True, object_cache=False):
+    """Splits a host's memory between Apache, PHP and MySQL, whichever
+    of them run on it, so that together they can't use more than the host
+    has. Runs on the controller, as the Ansible filter lampsible_capacity_plan,
+    with the host's facts, see the capacity role.
+
+    Returns a dict with the host's 'memory_mb', 'vcpus' and 'reserved_mb',
+    an 'apache' plan, if web is set, and a 'php' plan, if php is also set,
+    an 'object_cache' plan, if object_cache is also set, and a 'mysql' plan,
+    if database is set. Without PHP, Apache runs the event MPM, whatever
+    php_fpm says. Sizes are in MB, or strings like '256M', if they
+    go into configuration files like that.
+    """
+    reserved_mb  = max(CAPACITY_RESERVED_MB,
+        int(memtotal_mb * CAPACITY_RESERVED_SHARE))
+    available_mb = max(0, memtotal_mb - reserved_mb)
+    if web and database:
+        web_mb      = int(available_mb * CAPACITY_SHARED_WEB_SHARE)
+        database_mb = available_mb - web_mb
+    else:
+        web_mb      = available_mb if web else 0
+        database_mb = available_mb if database else 0
+
+    plan = {
+        'memory_mb':   memtotal_mb,
+        'vcpus':       vcpus,
+        'reserved_mb': reserved_mb,
+    }
+
+    if web and not php:
+        # Nothing but Apache, which Ubuntu runs with the event MPM.
+        server_limit = _clamp(
+            web_mb // CAPACITY_APACHE_PROCESS_MB,
+            2,
+            CAPACITY_MAX_SERVER_LIMIT
+        )
+        plan['apache'] = {
+            'mpm':                 'event',
+            'server_limit':        server_limit,
+            'threads_per_child':   CAPACITY_THREADS_PER_CHILD,
+            'max_request_workers': server_limit
+                * CAPACITY_THREADS_PER_CHILD,
+        }
+
+    elif web:
+        php_mb = web_mb - CAPACITY_OPCACHE_MB
+        if php_fpm:
+            php_mb -= CAPACITY_APACHE_MB
+        if object_cache:
+            php_mb -= CAPACITY_OBJECT_CACHE_MB
+            plan['object_cache'] = {
+                'memory_mb': CAPACITY_OBJECT_CACHE_MB,
+            }
+        max_children = max(2, php_mb // DEFAULT_PHP_FPM_PROCESS_MB)
+        # A single request may use more than the average, but not more
+        # than half of what's there for PHP, unless that's below PHP's
+        # own default.
+        memory_limit = _clamp(
+            PHP_MEMORY_LIMITS.get(action, DEFAULT_PHP_MEMORY_LIMIT),
+            DEFAULT_PHP_MEMORY_LIMIT,
+            max(DEFAULT_PHP_MEMORY_LIMIT, php_mb // 2)
+        )
+
+        if php_fpm:
+            # Threads are cheap, they mostly wait for PHP-FPM,
+            # or serve static files.
+            server_limit = _clamp(
+                ceil(max_children * 2 / CAPACITY_THREADS_PER_CHILD),
+                2,
+                CAPACITY_MAX_SERVER_LIMIT
+            )
+            plan['apache'] = {
+                'mpm':                 'event',
+                'server_limit':        server_limit,
+                'threads_per_child':   CAPACITY_THREADS_PER_CHILD,
+                'max_request_workers': server_limit
+                    * CAPACITY_THREADS_PER_CHILD,
+            }
+        else:
+            # Each Apache process runs PHP itself.
+            plan['apache'] = {
+                'mpm':                 'prefork',
+                'server_limit':        max_children,
+                'threads_per_child':   1,
+                'max_request_workers': max_children,
+            }
+
+        plan['php'] = {
+            'max_children': max_children,
+            'memory_limit': '{}M'.format(memory_limit),
+        }
+
+    if database:
+        # The buffer pool grows in chunks of 128 MB.
+        buffer_pool_mb = max(128,
+            int(database_mb * CAPACITY_BUFFER_POOL_SHARE) // 128 * 128)
+        tmp_table_mb   = _clamp(database_mb // 64, 16, 64)
+        connections_mb = max(0,
+            database_mb - buffer_pool_mb - CAPACITY_MYSQL_BASE_MB)
+        min_connections = CAPACITY_MIN_CONNECTIONS
+        if 'php' in plan:
+            min_connections = max(min_connections,
+                plan['php']['max_children'] + 10)
+        plan['mysql'] = {
+            'innodb_buffer_pool_size': '{}M'.format(buffer_pool_mb),
+            'max_connections':         _clamp(
+                connections_mb // CAPACITY_MYSQL_CONNECTION_MB,
+                min_connections,
+                CAPACITY_MAX_CONNECTIONS
+            ),
+            'tmp_table_size':          '{}M'.format(tmp_table_mb),
+            'max_heap_table_size':     '{}M'.format(tmp_table_mb),
+        }
+
+    return plan
+
+
+def print_capacity_plan(host, plan):
+    print('\n{}: {} MB, {} vCPUs, {} MB reserved for the system'.format(
+        host,
+        plan['memory_mb'],
+        plan['vcpus'],
+        plan['reserved_mb']
+    ))
+    if 'apache' in plan:
+        print('  Apache ({} MPM): ServerLimit {}, MaxRequestWorkers {}'.format(
+            plan['apache']['mpm'],
+            plan['apache']['server_limit'],
+            plan['apache']['max_request_workers']
+        ))
+    if 'php' in plan:
+        print('  PHP: {} processes, memory_limit {}'.format(
+            plan['php']['max_children'],
+            plan['php']['memory_limit']
+        ))
+    if 'object_cache' in plan:
+        print('  Object cache: {} MB'.format(
+            plan['object_cache']['memory_mb']
+        ))
+    if 'mysql' in plan:
+        print('  MySQL: innodb_buffer_pool_size {}, max_connections {}, '
+            'tmp_table_size {}'.format(
+                plan['mysql']['innodb_buffer_pool_size'],
+                plan['mysql']['max_connections'],
+                plan['mysql']['tmp_table_size']
+            ))
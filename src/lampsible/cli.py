@@ -1,17 +1,21 @@
+import sys
 import argparse
 from textwrap import dedent
-from ansible_runner import Runner, RunnerConfig, run_command
 from . import __version__
 from .constants import *
-from .lampsible import Lampsible
 from .arg_validator import ArgValidator
+# Lampsible, RunHistory and the profiler are only imported once they are
+# needed, because they pull in Ansible, which makes '--help', '--version'
+# and invalid input noticeably slower.
 
 
-def main():
-
+def get_arg_parser():
     parser = argparse.ArgumentParser(
         prog='lampsible',
-        description='LAMP Stacks with Ansible',
+        description="""
+        LAMP Stacks with Ansible. Run 'lampsible history --help'
+        to see how to list your past runs.
+        """,
     )
 
     # ----------------------
@@ -21,7 +25,11 @@ def main():
     # ----------------------
 
     parser.add_argument('web_user_host', nargs='?',
-        help="example: someuser@somehost.com"
+        help="""
+        example: someuser@somehost.com - You can also pass a comma separated
+        list of hosts, like someuser@host1.com,someuser@host2.com,
+        to deploy all of them in a single run.
+        """
     )
     parser.add_argument('action', choices=SUPPORTED_ACTIONS, nargs='?')
 
@@ -79,6 +87,18 @@ def main():
         pass this, and Ansible will install database stuff here.
         Otherwise, leave blank, and Ansible will install database
         stuff on web server, like in v1.
+        Like the first positional argument, this can also be a comma
+        separated list of hosts.
+        """
+    )
+    parser.add_argument('--parallel-database',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="""
+        If your database server is different than your web server,
+        Lampsible sets up both of them at the same time, until the web server
+        needs the database, for example, to install WordPress.
+        Pass --no-parallel-database to set them up one after the other.
         """
     )
     # TODO
@@ -93,6 +113,62 @@ def main():
         based on your remote server
         """.format(DEFAULT_PHP_VERSION)
     )
+    parser.add_argument('--php-fpm',
+        action=argparse.BooleanOptionalAction,
+        help="""
+        Whether Apache should serve PHP through PHP-FPM and the event MPM,
+        with a PHP-FPM pool of its own for your site, instead of mod_php.
+        This is the default for the actions {}, and can also be used
+        with 'lamp-stack'.
+        """.format(', '.join(PHP_FPM_ACTIONS))
+    )
+    parser.add_argument('--php-fpm-pm', choices=AVAILABLE_PHP_FPM_PM,
+        help="""
+        how the PHP-FPM pool of your site manages its processes, one of {}.
+        Leave it blank to let Lampsible pick based on your server's memory.
+        """.format(', '.join(AVAILABLE_PHP_FPM_PM))
+    )
+    parser.add_argument('--php-fpm-max-children', type=int,
+        help="""
+        the maximum number of PHP processes of your site. Leave it blank
+        to let Lampsible compute it from your server's memory, assuming
+        {} MB per process, and leaving enough for Apache, OPcache and,
+        if it runs on the same server, MySQL.
+        """.format(DEFAULT_PHP_FPM_PROCESS_MB)
+    )
+    parser.add_argument('--php-fpm-max-requests', type=int,
+        default=DEFAULT_PHP_FPM_MAX_REQUESTS,
+        help="""
+        how many requests each PHP process serves before it's replaced
+        by a fresh one, or 0 to never replace them. Defaults to {}.
+        """.format(DEFAULT_PHP_FPM_MAX_REQUESTS)
+    )
+    parser.add_argument('--php-opcache',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="""
+        Whether Lampsible should tune OPcache for your WordPress, Joomla,
+        Drupal or Laravel site, based on how many PHP files it has.
+        Pass --no-php-opcache to leave PHP's configuration alone.
+        """
+    )
+    parser.add_argument('--php-opcache-jit', action='store_true',
+        help="""
+        Pass this flag to enable PHP's JIT compiler, which needs PHP 8.0
+        or newer. It rarely makes websites faster, but it can help
+        code that does a lot of computation.
+        """
+    )
+    parser.add_argument('--php-opcache-validate-timestamps',
+        action=argparse.BooleanOptionalAction,
+        help="""
+        Whether OPcache should check PHP files for changes. By default,
+        it doesn't for {} sites in production, which only change when you
+        deploy them, and OPcache is reset after each deployment instead.
+        """.format(' and '.join([
+            action.capitalize() for action in PHP_OPCACHE_NO_VALIDATE_ACTIONS
+        ]))
+    )
     # TODO
     # parser.add_argument('--php-my-admin', action='store_true')
 
@@ -134,6 +210,35 @@ def main():
             DEFAULT_WORDPRESS_LOCALE
         )
     )
+    parser.add_argument('--wordpress-object-cache',
+        choices=AVAILABLE_WORDPRESS_OBJECT_CACHES,
+        help="""
+        run Redis or Memcached on the web server, and use it as your
+        WordPress site's persistent object cache, so that options and other
+        data don't have to be fetched from the database on each request.
+        Helps most if the database runs on another server. One of: {}
+        """.format(', '.join(AVAILABLE_WORDPRESS_OBJECT_CACHES))
+    )
+
+    # Page cache
+    # ----------
+    parser.add_argument('--page-cache',
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="""
+        Whether Apache should cache the pages of your WordPress, Joomla
+        or Drupal site for visitors that aren't logged in, so that those
+        don't have to run PHP. Logged in users and the admin area bypass
+        the cache, and it's emptied after each deployment.
+        """
+    )
+    parser.add_argument('--page-cache-ttl', type=int,
+        default=DEFAULT_PAGE_CACHE_TTL,
+        help="""
+        for how many seconds the page cache keeps pages, at most.
+        Defaults to {}.
+        """.format(DEFAULT_PAGE_CACHE_TTL)
+    )
 
     # Joomla
     # ------
@@ -173,6 +278,24 @@ def main():
         for example /path/to/some-app-2.0.tar.gz
         """
     )
+    parser.add_argument('--app-delta-upload',
+        action=argparse.BooleanOptionalAction,
+        default=DEFAULT_APP_DELTA_UPLOAD,
+        help="""
+        Whether to upload only the files of your build-archive that differ
+        from the ones on the server, instead of the whole archive. Files are
+        compared by their SHA-256 checksum. Pass --no-app-delta-upload
+        to always upload the whole archive.
+        """
+    )
+    parser.add_argument('--app-delta-basis',
+        help="""
+        If your app isn't on the server yet, but a previous release of it is,
+        pass that release's path on the server, for example
+        /var/www/html/some-app-1.9, and it will be copied over first,
+        so that only the files that changed since then are uploaded.
+        """
+    )
 
     # SSL
     # ---
@@ -190,6 +313,27 @@ def main():
         because it makes your site look untrustworthy to visitors.
         """
     )
+    parser.add_argument('--ssl-key-type', choices=AVAILABLE_SSL_KEY_TYPES,
+        default=DEFAULT_SSL_KEY_TYPE,
+        help="""
+        the type of key for your self signed certificate, one of {}.
+        Defaults to {}. An existing key is kept, unless its type changes.
+        """.format(
+            ', '.join(AVAILABLE_SSL_KEY_TYPES),
+            DEFAULT_SSL_KEY_TYPE)
+    )
+    parser.add_argument('--ssl-dh-group', choices=AVAILABLE_SSL_DH_GROUPS,
+        default=DEFAULT_SSL_DH_GROUP,
+        help="""
+        the Diffie-Hellman group to use along with your self signed
+        certificate. The standardized groups {} ship with Lampsible.
+        Pass 'generate' to generate a group of your own on the server,
+        which can take several minutes, but only happens once.
+        Defaults to {}.
+        """.format(
+            ', '.join(AVAILABLE_SSL_DH_GROUPS[:-1]),
+            DEFAULT_SSL_DH_GROUP)
+    )
     parser.add_argument('--email-for-ssl',
         help="""
         the email address that will be passed to Certbot.
@@ -229,14 +373,108 @@ def main():
     )
     parser.add_argument('--ssh-key-file', '-i',  help='path to your private SSH key')
     parser.add_argument('--private-data-dir',
-        default=DEFAULT_PRIVATE_DATA_DIR,
         help="""
         the "private data directory" that Ansible Runner will use.
-        Default is '{}'. You can use this flag to pass an alternative value.
+        By default, Lampsible creates a fresh directory inside '{}'.
+        You can use this flag to pass an alternative value.
         However, it's best to just leave this blank.
         Be advised that Ansible Runner will write sensitive data here,
         like your private SSH key and passwords,
         but Lampsible will delete this directory when it finishes.
+        """.format(DEFAULT_PRIVATE_DATA_DIR)
+    )
+    parser.add_argument('--forks', type=int,
+        help="""
+        the number of hosts that Ansible will work on in parallel.
+        Leave this blank to use one fork per host, up to a maximum of {}.
+        """.format(MAX_DEFAULT_FORKS)
+    )
+    parser.add_argument('--serial', default=DEFAULT_SERIAL,
+        help="""
+        If you are deploying to many hosts, use this to roll out your
+        deployment in batches. Pass a number of hosts, like '5',
+        or a percentage of hosts, like '25%%'. Defaults to '{}',
+        which means all hosts in a single batch.
+        """.format(DEFAULT_SERIAL.replace('%', '%%'))
+    )
+    parser.add_argument('--fact-cache-ttl', type=int,
+        default=DEFAULT_FACT_CACHE_TTL,
+        help="""
+        Lampsible keeps the Ansible facts of your hosts in '{}',
+        so that it doesn't have to gather them again on every run.
+        This is how long, in seconds, they are kept. Defaults to {}.
+        Pass 0 to always gather fresh facts.
+        """.format(DEFAULT_FACT_CACHE_DIR, DEFAULT_FACT_CACHE_TTL)
+    )
+    parser.add_argument('--ssh-pipelining',
+        action=argparse.BooleanOptionalAction,
+        default=DEFAULT_SSH_PIPELINING,
+        help="""
+        Whether Ansible should pipeline modules over SSH, instead of
+        uploading each of them to a temporary file first. This is much faster,
+        but requires that 'requiretty' is disabled in the remote server's
+        sudoers configuration, which is the default on Ubuntu.
+        """
+    )
+    parser.add_argument('--ssh-control-persist',
+        default=DEFAULT_SSH_CONTROL_PERSIST,
+        help="""
+        how long an idle SSH connection to each host is kept open, so that
+        later tasks can reuse it. Defaults to '{}'. Pass '0' to open a new
+        connection for every task.
+        """.format(DEFAULT_SSH_CONTROL_PERSIST)
+    )
+    parser.add_argument('--ssh-timeout', type=int,
+        default=DEFAULT_SSH_TIMEOUT,
+        help="""
+        SSH connection timeout in seconds, defaults to {}.
+        """.format(DEFAULT_SSH_TIMEOUT)
+    )
+    parser.add_argument('--incremental', action='store_true',
+        help="""
+        Pass this flag to only run those parts of the deployment that have
+        changed since the last time you ran Lampsible against the same hosts.
+        Lampsible keeps track of this in /var/lib/lampsible/manifest.json
+        on each host. This makes redeploys much faster, but if something
+        was changed on the server by hand, Lampsible won't notice it.
+        """
+    )
+    parser.add_argument('--plan', action='store_true',
+        help="""
+        Pass this flag to only show what Lampsible would change on your
+        hosts, without actually changing anything. This runs Ansible in
+        check mode, which can't predict everything, so consider it a preview.
+        """
+    )
+    parser.add_argument('--profile', action='store_true',
+        help="""
+        Pass this flag to record how long each task, role and host took.
+        Lampsible prints the slowest ones when it finishes, and saves the
+        full report as JSON in the directory passed with '--profile-dir'.
+        """
+    )
+    parser.add_argument('--profile-dir', default=DEFAULT_PROFILE_DIR,
+        help="""
+        where to save profiling reports. Defaults to '{}'.
+        """.format(DEFAULT_PROFILE_DIR)
+    )
+    parser.add_argument('--profile-compare',
+        help="""
+        path to the JSON report of an earlier run with '--profile'.
+        If you pass this, Lampsible also shows how much faster or slower
+        each role and task was this time.
+        """
+    )
+    parser.add_argument('--history-file', default=DEFAULT_HISTORY_FILE,
+        help="""
+        the SQLite database where Lampsible records each run, including how
+        long each role took. Defaults to '{}'.
+        Run 'lampsible history' to see them.
+        """.format(DEFAULT_HISTORY_FILE)
+    )
+    parser.add_argument('--no-history', action='store_true',
+        help="""
+        Pass this flag to not record this run in the history.
         """
     )
     parser.add_argument('--ansible-galaxy-ok', action='store_true',
@@ -311,6 +549,29 @@ def main():
         Pass this flag to create the specified Composer project.
         """
     )
+    parser.add_argument('--composer-cache-dir',
+        default=DEFAULT_COMPOSER_CACHE_DIR,
+        help="""
+        Composer's cache directory on the remote server, defaults to '{}'.
+        It is kept between runs, so that packages don't have to be
+        downloaded again.
+        """.format(DEFAULT_COMPOSER_CACHE_DIR)
+    )
+    parser.add_argument('--composer-dev', action='store_true',
+        help="""
+        Pass this flag to also install the development dependencies of
+        your Composer project and packages. By default, Lampsible
+        installs only what's needed in production.
+        """
+    )
+    parser.add_argument('--composer-classmap-authoritative',
+        action='store_true',
+        help="""
+        Pass this flag to have Composer generate an authoritative classmap,
+        which makes autoloading faster, but means that classes that are not
+        in the classmap will not be found.
+        """
+    )
 
     # All CMS
     # -------
@@ -395,7 +656,15 @@ def main():
         version=__version__
     )
 
-    args = parser.parse_args()
+    return parser
+
+
+def main():
+
+    if sys.argv[1:2] == ['history']:
+        return history_main(sys.argv[2:])
+
+    args = get_arg_parser().parse_args()
 
     print(LAMPSIBLE_BANNER)
 
@@ -413,9 +682,15 @@ def main():
 
     args = validator.get_validated_args()
 
+    from .lampsible import Lampsible
+    from .profiler import (
+        load_profile_report, print_profile_report,
+        compare_profile_reports, print_profile_comparison
+    )
+
     lampsible = Lampsible(
         web_user=args.web_user,
-        web_host=args.web_host,
+        web_host=args.web_hosts,
         action=args.action,
         private_data_dir=args.private_data_dir,
         apache_server_admin=args.apache_server_admin,
@@ -433,6 +708,8 @@ def main():
             ]
             )),
         ssl_selfsigned=args.ssl_selfsigned,
+        ssl_key_type=args.ssl_key_type,
+        ssl_dh_group=args.ssl_dh_group,
         ssl_test_cert=args.ssl_test_cert,
         email_for_ssl=args.email_for_ssl,
         database_username=args.database_username,
@@ -441,12 +718,24 @@ def main():
         database_host=args.database_host,
         database_table_prefix=args.database_table_prefix,
         database_system_user=args.database_system_user,
-        database_system_host=args.database_system_host,
+        database_system_host=args.database_system_hosts,
+        parallel_database=args.parallel_database,
+        incremental=args.incremental,
         php_version=args.php_version,
         php_extensions=args.php_extensions,
+        php_fpm=args.php_fpm,
+        php_fpm_pm=args.php_fpm_pm,
+        php_fpm_max_children=args.php_fpm_max_children,
+        php_fpm_max_requests=args.php_fpm_max_requests,
+        php_opcache=args.php_opcache,
+        php_opcache_jit=args.php_opcache_jit,
+        php_opcache_validate_timestamps=args.php_opcache_validate_timestamps,
         composer_packages=args.composer_packages,
         composer_working_directory=args.composer_working_directory,
         composer_project=args.composer_project,
+        composer_cache_dir=args.composer_cache_dir,
+        composer_no_dev=(not args.composer_dev),
+        composer_classmap_authoritative=args.composer_classmap_authoritative,
         site_title=args.site_title,
         admin_username=args.admin_username,
         admin_password=args.admin_password,
@@ -454,11 +743,16 @@ def main():
         wordpress_version=args.wordpress_version,
         wordpress_locale=args.wordpress_locale,
         wordpress_insecure_allow_xmlrpc=args.wordpress_insecure_allow_xmlrpc,
+        wordpress_object_cache=args.wordpress_object_cache,
+        page_cache=args.page_cache,
+        page_cache_ttl=args.page_cache_ttl,
         joomla_version=args.joomla_version,
         joomla_admin_full_name=args.joomla_admin_full_name,
         drupal_profile=args.drupal_profile,
         app_name=args.app_name,
         app_build_path=args.app_build_path,
+        app_delta_upload=args.app_delta_upload,
+        app_delta_basis=args.app_delta_basis,
         laravel_artisan_commands=args.laravel_artisan_commands,
         app_local_env=args.app_local_env,
         extra_env_vars=args.extra_env_vars,
@@ -466,30 +760,96 @@ def main():
         ssh_key_file=args.ssh_key_file,
         remote_sudo_password=args.remote_sudo_password,
         ansible_galaxy_ok=args.ansible_galaxy_ok,
+        forks=args.forks,
+        serial=args.serial,
+        fact_cache_ttl=args.fact_cache_ttl,
+        ssh_pipelining=args.ssh_pipelining,
+        ssh_control_persist=(
+            None if args.ssh_control_persist == '0'
+            else args.ssh_control_persist
+        ),
+        ssh_timeout=args.ssh_timeout,
+        profile_dir=args.profile_dir,
+        history_file=(None if args.no_history else args.history_file),
         interactive=True,
     )
 
     if args.action == 'dump-ansible-facts':
-        # TODO: Refactor this.
-        run_command(
-            executable_cmd='ansible',
-            cmdline_args=[
-                '-i',
-                '{}@{},'.format(
-                    args.web_user,
-                    args.web_host,
-                ),
-                'ungrouped',
-                '-m',
-                'setup'
-            ]
-        )
-        lampsible.private_data_helper.cleanup_dir()
-        return 0
+        return lampsible.dump_ansible_facts()
+
+    elif args.plan:
+        lampsible.plan()
+        lampsible.print_plan_summary()
+        lampsible.print_capacity_plans()
+        return lampsible.rc
+
+    elif args.profile:
+        result = lampsible.run(profile=True)
+        print_profile_report(lampsible.profile_report)
+        if args.profile_compare:
+            print_profile_comparison(compare_profile_reports(
+                load_profile_report(args.profile_compare),
+                lampsible.profile_report
+            ))
+        print('\nSaved profiling report to {}'.format(
+            lampsible.profile_report_path))
+        return result
 
     else:
-        lampsible.run()
+        return lampsible.run()
+
+
+def history_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='lampsible history',
+        description="""
+        Lists your past Lampsible runs, newest first, and flags roles that
+        took much longer than usual, compared to the median of earlier
+        successful runs with the same action and hosts.
+        """,
+    )
+    parser.add_argument('--action', choices=SUPPORTED_ACTIONS,
+        help='only list runs of this action')
+    parser.add_argument('--host', help='only list runs against this host')
+    parser.add_argument('--limit', type=int, default=DEFAULT_HISTORY_LIMIT,
+        help='how many runs to list, defaults to {}'.format(
+            DEFAULT_HISTORY_LIMIT))
+    parser.add_argument('--window', type=int, default=DEFAULT_HISTORY_WINDOW,
+        help="""
+        how many earlier runs the median is taken from, defaults to {}
+        """.format(DEFAULT_HISTORY_WINDOW)
+    )
+    parser.add_argument('--threshold', type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="""
+        how much slower than the median a role has to be, to be flagged.
+        Defaults to {}, which means {}%%.
+        """.format(
+            DEFAULT_REGRESSION_THRESHOLD,
+            round(DEFAULT_REGRESSION_THRESHOLD * 100)
+        )
+    )
+    parser.add_argument('--history-file', default=DEFAULT_HISTORY_FILE,
+        help='defaults to {}'.format(DEFAULT_HISTORY_FILE))
+    args = parser.parse_args(argv)
 
+    if args.limit < 1 or args.window < 1 or args.threshold < 0:
+        print('FATAL! --limit and --window must be at least 1, '
+            'and --threshold must not be negative.')
+        return 1
+
+    from .history import RunHistory, print_run_history
+    history = RunHistory(args.history_file)
+    print_run_history(
+        history,
+        history.get_runs(
+            action=args.action,
+            host=args.host,
+            limit=args.limit
+        ),
+        window=args.window,
+        threshold=args.threshold
+    )
     return 0
 
 
@@ -1,19 +1,45 @@
 import os
 from . import __version__
-from sys import path as sys_path
+from functools import cache
+from importlib.resources import files
 
+
+@cache
 def find_package_project_dir():
-    for path_str in sys_path:
-        try:
-            try_path = os.path.join(path_str, 'lampsible', 'project')
-            assert os.path.isdir(try_path)
-            return try_path
-        except AssertionError:
-            pass
-    raise RuntimeError("""
-        Could not find a 'project_dir' for Ansible Runner in the expected
-        location. Your Lampsible installation is likely broken, please reinstall.
-        """)
+    # The 'project' directory is shipped inside the lampsible package.
+    project_dir = str(files(__package__).joinpath('project'))
+    if not os.path.isdir(project_dir):
+        raise RuntimeError("""
+            Could not find a 'project_dir' for Ansible Runner in the expected
+            location. Your Lampsible installation is likely broken, please reinstall.
+            """)
+    return project_dir
+
+
+def get_galaxy_requirements_file():
+    return os.path.join(find_package_project_dir(),
+        'ansible-galaxy-requirements.yml')
+
+
+# Optional. Collection tarballs, like 'community-general-10.2.0.tar.gz',
+# that were shipped along with Lampsible. If a missing collection
+# is found here, it is installed without touching the network.
+def get_vendored_collections_dir():
+    return os.path.join(find_package_project_dir(), 'collections')
+
+
+# These used to be plain constants, but resolving them means looking for
+# the package on disk, which only the commands that run Ansible need.
+def __getattr__(name):
+    try:
+        return {
+            'PROJECT_DIR':              find_package_project_dir,
+            'GALAXY_REQUIREMENTS_FILE': get_galaxy_requirements_file,
+            'VENDORED_COLLECTIONS_DIR': get_vendored_collections_dir,
+        }[name]()
+    except KeyError:
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(__name__, name))
 
 # Lampsible
 # ---------
@@ -51,10 +77,105 @@ SUPPORTED_ACTIONS = [
 # Script paths
 # ------------
 USER_HOME_DIR            = os.path.expanduser('~')
-PROJECT_DIR              = find_package_project_dir()
-GALAXY_REQUIREMENTS_FILE = os.path.join(PROJECT_DIR,
-    'ansible-galaxy-requirements.yml')
 DEFAULT_PRIVATE_DATA_DIR = os.path.join(USER_HOME_DIR, '.lampsible')
+# Unlike the private data directory, this is not deleted after each run.
+USER_CACHE_DIR           = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(USER_HOME_DIR, '.cache')),
+    'lampsible'
+)
+
+# Known WordPress and Joomla versions, see VersionIndex.
+DEFAULT_VERSION_INDEX_FILE    = os.path.join(USER_CACHE_DIR, 'versions.json')
+DEFAULT_VERSION_INDEX_TTL     = 86400
+DEFAULT_VERSION_INDEX_TIMEOUT = 5
+
+# Artifacts, like WP-CLI and the WordPress and Joomla packages, are
+# downloaded once onto the controller, and pushed to the hosts from there,
+# see ArtifactCache. On the hosts, they are kept in REMOTE_ARTIFACT_DIR,
+# so that they are only pushed again if they changed.
+DEFAULT_ARTIFACT_CACHE_DIR = os.path.join(USER_CACHE_DIR, 'artifacts')
+DEFAULT_ARTIFACT_TTL       = 86400
+DEFAULT_ARTIFACT_TIMEOUT   = 30
+REMOTE_ARTIFACT_DIR        = '/var/cache/lampsible/artifacts'
+
+# Ansible Runner
+# --------------
+# If no forks are passed, Lampsible uses one fork per host,
+# but never more than this.
+MAX_DEFAULT_FORKS = 25
+# Run all hosts in a single batch, unless told otherwise.
+DEFAULT_SERIAL    = '100%'
+# How many independent deployments run_many runs at the same time.
+DEFAULT_MAX_CONCURRENT_DEPLOYMENTS = 4
+# Facts of each host are kept between runs, for this many seconds.
+DEFAULT_FACT_CACHE_DIR = os.path.join(USER_CACHE_DIR, 'facts')
+DEFAULT_FACT_CACHE_TTL = 86400
+# Lampsible.stream buffers at most this many events. If the consumer
+# falls behind, the run waits for it.
+EVENT_QUEUE_SIZE = 1000
+
+# Profiler
+# --------
+# Unlike the private data directory, this is not deleted after each run.
+DEFAULT_PROFILE_DIR    = os.path.join(DEFAULT_PRIVATE_DATA_DIR, 'profiles')
+DEFAULT_PROFILE_TOP_N  = 15
+PROFILE_REPORT_VERSION = 1
+
+# Run history
+# -----------
+DEFAULT_HISTORY_FILE = os.path.join(DEFAULT_PRIVATE_DATA_DIR, 'history.sqlite3')
+DEFAULT_HISTORY_LIMIT = 20
+# A role regressed if it took more than DEFAULT_REGRESSION_THRESHOLD
+# (0.25 = 25%) and more than DEFAULT_REGRESSION_MIN_SECONDS longer than its
+# median in the last DEFAULT_HISTORY_WINDOW successful runs with the same
+# action and hosts. It needs at least DEFAULT_HISTORY_MIN_SAMPLES of those.
+DEFAULT_HISTORY_WINDOW         = 10
+DEFAULT_HISTORY_MIN_SAMPLES    = 3
+DEFAULT_REGRESSION_THRESHOLD   = 0.25
+DEFAULT_REGRESSION_MIN_SECONDS = 1.0
+
+# Capacity planner
+# ----------------
+# See capacity.py. Memory is in MB.
+# Left for the operating system, and anything else on the host.
+CAPACITY_RESERVED_MB         = 256
+CAPACITY_RESERVED_SHARE      = 0.1
+# If web server and database share a host, the web server gets this share
+# of the memory that's left, and the database the rest.
+CAPACITY_SHARED_WEB_SHARE    = 0.5
+# Apache's own processes, with the event MPM, and OPcache's shared memory.
+CAPACITY_APACHE_MB           = 128
+CAPACITY_OPCACHE_MB          = 128
+# Redis or Memcached, if WordPress uses them as object cache.
+CAPACITY_OBJECT_CACHE_MB     = 64
+CAPACITY_THREADS_PER_CHILD   = 25
+# Without PHP, Apache only serves static files, and each of its processes,
+# along with its threads, needs about this much.
+CAPACITY_APACHE_PROCESS_MB   = 32
+CAPACITY_MAX_SERVER_LIMIT    = 64
+PHP_MEMORY_LIMITS = {
+    'wordpress': 256,
+    'joomla':    256,
+    'drupal':    256,
+    'laravel':   256,
+}
+DEFAULT_PHP_MEMORY_LIMIT     = 128
+# Share of the database's memory for the InnoDB buffer pool. The rest is
+# for its own overhead, CAPACITY_MYSQL_BASE_MB, and connections, each of
+# which might need CAPACITY_MYSQL_CONNECTION_MB.
+CAPACITY_BUFFER_POOL_SHARE   = 0.6
+CAPACITY_MYSQL_BASE_MB       = 128
+CAPACITY_MYSQL_CONNECTION_MB = 4
+CAPACITY_MIN_CONNECTIONS     = 20
+CAPACITY_MAX_CONNECTIONS     = 1000
+
+# SSH
+# ---
+DEFAULT_SSH_PIPELINING      = True
+# How long an idle SSH master connection is kept open. Its socket
+# lives in the private data directory.
+DEFAULT_SSH_CONTROL_PERSIST = '60s'
+DEFAULT_SSH_TIMEOUT         = 10
 
 # Apache
 # ------
@@ -62,6 +183,44 @@ DEFAULT_APACHE_VHOST_NAME = '000-default'
 DEFAULT_APACHE_SERVER_NAME = 'localhost'
 DEFAULT_APACHE_SERVER_ADMIN = 'webmaster@localhost'
 DEFAULT_APACHE_DOCUMENT_ROOT = '/var/www/html'
+# Full-page cache, see --page-cache. Pages are kept in Apache's disk cache,
+# for DEFAULT_PAGE_CACHE_TTL seconds, unless the site says otherwise.
+# Requests with one of the cookies, which logged in users have, and
+# requests to one of the paths, bypass it.
+PAGE_CACHE_ACTIONS = ['wordpress', 'joomla', 'drupal']
+DEFAULT_PAGE_CACHE_TTL = 300
+APACHE_PAGE_CACHE_ROOT = '/var/cache/apache2/mod_cache_disk'
+PAGE_CACHE_BYPASS = {
+    'wordpress': {
+        'cookies': [
+            'wordpress_logged_in_',
+            'wp-postpass_',
+            'comment_author_',
+            'woocommerce_items_in_cart',
+        ],
+        'paths':   ['/wp-admin', '/wp-login.php', '/xmlrpc.php'],
+    },
+    'joomla': {
+        'cookies': ['joomla_user_state=logged_in'],
+        'paths':   ['/administrator', '/api'],
+    },
+    'drupal': {
+        # Drupal only starts sessions for logged in users.
+        'cookies': ['S?SESS[0-9a-f]+='],
+        'paths':   ['/user', '/admin', '/core/install.php'],
+    },
+}
+
+# SSL
+# ---
+# Self signed certificates only. Elliptic curve keys are smaller and faster,
+# but some very old clients don't support them.
+AVAILABLE_SSL_KEY_TYPES = ['rsa', 'ecdsa']
+DEFAULT_SSL_KEY_TYPE    = 'rsa'
+# The standardized groups of RFC 7919 ship with Lampsible, and are what
+# Mozilla recommends. Generating a group takes minutes on small servers.
+AVAILABLE_SSL_DH_GROUPS = ['ffdhe2048', 'ffdhe3072', 'ffdhe4096', 'generate']
+DEFAULT_SSL_DH_GROUP    = 'ffdhe2048'
 
 # Database
 # --------
@@ -78,6 +237,32 @@ SUPPORTED_PHP_VERSIONS = [
     '7.4', '7.3', '7.2', '7.1', '7.0',
     '5.6', '5.5', '5.4',
 ]
+# Actions that serve PHP through PHP-FPM and Apache's event MPM by default,
+# instead of mod_php, which needs the prefork MPM. 'lamp-stack' can be
+# told to, as well.
+PHP_FPM_ACTIONS = ['wordpress', 'joomla', 'drupal', 'laravel']
+AVAILABLE_PHP_FPM_PM = ['static', 'dynamic', 'ondemand']
+# Each site gets its own pool, listening on this socket.
+PHP_FPM_SOCKET = '/run/php/lampsible-{}.sock'
+# Unless told otherwise, pools are sized from the host's memory, assuming
+# that each PHP process needs DEFAULT_PHP_FPM_PROCESS_MB, see capacity.py.
+DEFAULT_PHP_FPM_PROCESS_MB   = 64
+DEFAULT_PHP_FPM_MAX_REQUESTS = 500
+# Actions whose PHP code is only changed by deployments, so OPcache doesn't
+# need to check files for changes, and is reset after each deployment
+# instead. WordPress and Joomla update themselves.
+PHP_OPCACHE_NO_VALIDATE_ACTIONS = ['drupal', 'laravel']
+# Relative to the app's directory. These are compiled into OPcache when
+# PHP starts, see https://www.php.net/manual/en/opcache.preloading.php
+PHP_OPCACHE_PRELOAD_PATHS = {
+    'drupal':  ['web/core/lib/Drupal/Component', 'web/core/lib/Drupal/Core'],
+    'laravel': ['vendor/laravel/framework/src/Illuminate'],
+}
+# Composer
+# --------
+# On the remote host, outside of any project, so that it survives reruns.
+DEFAULT_COMPOSER_CACHE_DIR = '/var/cache/composer'
+
 REQUIRED_PHP_EXTENSIONS = {
     'lamp-stack': ['mysql'],
     'wordpress': [
@@ -105,6 +290,44 @@ REQUIRED_PHP_EXTENSIONS = {
     ],
 }
 
+# APT
+# ---
+# System packages that each action needs on its web servers and on its
+# database servers. Lampsible adds PHP, PHP extensions and Composer to these,
+# depending on the action, and installs everything in one APT transaction
+# per host group.
+REQUIRED_APT_PACKAGES = {
+    'lamp-stack': {
+        'web_servers':      ['apache2', 'fail2ban'],
+        'database_servers': ['python3-pip', 'mysql-server'],
+    },
+    'apache': {
+        'web_servers':      ['apache2', 'fail2ban'],
+    },
+    'mysql': {
+        'database_servers': ['python3-pip', 'mysql-server', 'fail2ban'],
+    },
+    'php': {
+        'web_servers':      ['fail2ban'],
+    },
+    'wordpress': {
+        'web_servers':      ['apache2', 'fail2ban'],
+        'database_servers': ['python3-pip', 'mysql-server'],
+    },
+    'joomla': {
+        'web_servers':      ['apache2', 'fail2ban'],
+        'database_servers': ['python3-pip', 'mysql-server'],
+    },
+    'drupal': {
+        'web_servers':      ['apache2', 'fail2ban'],
+        'database_servers': ['python3-pip', 'mysql-server'],
+    },
+    'laravel': {
+        'web_servers':      ['apache2', 'fail2ban'],
+        'database_servers': ['python3-pip', 'mysql-server'],
+    },
+}
+
 # All CMS
 # -------
 DEFAULT_SITE_TITLE     = 'Sample Site'
@@ -115,6 +338,8 @@ DEFAULT_ADMIN_EMAIL    = 'admin@example.com'
 # ---------
 DEFAULT_WORDPRESS_VERSION = 'latest'
 DEFAULT_WORDPRESS_LOCALE  = 'en_US'
+WP_CLI_DOWNLOAD_URL = 'https://raw.githubusercontent.com/wp-cli/builds/gh-pages/phar/wp-cli.phar'
+WP_CLI_CHECKSUM     = 'sha512:{}.sha512'.format(WP_CLI_DOWNLOAD_URL)
 RECENT_WORDPRESS_VERSIONS = [
     'latest',
     'nightly',
@@ -123,11 +348,33 @@ RECENT_WORDPRESS_VERSIONS = [
     '6.5.5', '6.5.4', '6.5.3', '6.5.2', '6.5',
     '6.4.4', '6.4.3', '6.4.2', '6.4.1', '6.4',
 ]
+# Persistent object caches. The cache server, whose APT package and service
+# have the same name, runs on the web server, WordPress talks to it through
+# the PHP extension, and the plugin provides wp-content/object-cache.php.
+AVAILABLE_WORDPRESS_OBJECT_CACHES = ['redis', 'memcached']
+WORDPRESS_OBJECT_CACHES = {
+    'redis': {
+        'server':        'redis-server',
+        'php_extension': 'redis',
+        'plugin':        'redis-cache',
+        'port':          6379,
+    },
+    'memcached': {
+        'server':        'memcached',
+        'php_extension': 'memcache',
+        'plugin':        'memcached',
+        'port':          11211,
+    },
+}
+# Lists all WordPress releases.
+WORDPRESS_VERSIONS_URL = 'https://api.wordpress.org/core/stable-check/1.0/'
+WORDPRESS_DOWNLOAD_URL = 'https://wordpress.org/wordpress-{}.tar.gz'
 
 # Joomla
 # ------
 DEFAULT_JOOMLA_VERSION         = '5.2.3'
 DEFAULT_JOOMLA_ADMIN_FULL_NAME = 'Sample User'
+JOOMLA_DOWNLOAD_URL = 'https://downloads.joomla.org/cms/joomla{major}/{version}/Joomla_{version}-Stable-Full_Package.tar.gz'
 
 # DRUPAL
 
@@ -142,6 +389,10 @@ DEFAULT_LARAVEL_ARTISAN_COMMANDS = [
     'migrate',
     'db:seed',
 ]
+# Only upload the files of a build that differ from what's on the host.
+DEFAULT_APP_DELTA_UPLOAD = True
+# On the remote host. Checksums of the deployed files, one JSON file per app.
+REMOTE_APP_CHECKSUM_DIR  = '/var/lib/lampsible/app-checksums'
 
 # Misc
 # ----
@@ -0,0 +1,218 @@
+import os
+import json
+import sqlite3
+from statistics import median
+from lampsible.constants import *
+
+
+class RunHistory():
+    """A local SQLite database with the metadata of past Lampsible runs,
+    so that deployments that got slower can be spotted without
+    any external tooling. See Lampsible.run and 'lampsible history'.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_FILE):
+        self.path = path
+
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Several Lampsible objects might write at the same time,
+        # see run_many, so wait for each other's locks.
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id             INTEGER PRIMARY KEY AUTOINCREMENT,
+                started        TEXT,
+                action         TEXT,
+                hosts          TEXT,
+                versions       TEXT,
+                rc             INTEGER,
+                total_duration REAL,
+                changed        INTEGER,
+                failures       INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS run_roles (
+                run_id   INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+                role     TEXT,
+                duration REAL,
+                changed  INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS runs_action_hosts
+                ON runs (action, hosts);
+        """)
+        return connection
+
+
+    def add_run(self, action, hosts, versions, rc, host_stats, profile_report):
+        """Stores one run and returns its id. host_stats is like
+        Lampsible.get_host_stats, profile_report like Profiler.get_report.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    """
+                    INSERT INTO runs (started, action, hosts, versions, rc,
+                        total_duration, changed, failures)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        profile_report['started'],
+                        action,
+                        ','.join(sorted(hosts)),
+                        json.dumps(versions, sort_keys=True),
+                        rc,
+                        profile_report['total_duration'],
+                        sum(stats['changed'] for stats in host_stats.values()),
+                        sum(
+                            stats['failures'] + stats['dark']
+                            for stats in host_stats.values()
+                        ),
+                    )
+                )
+                run_id = cursor.lastrowid
+                connection.executemany(
+                    """
+                    INSERT INTO run_roles (run_id, role, duration, changed)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            run_id,
+                            role,
+                            duration,
+                            profile_report['changed'].get(role, 0)
+                        )
+                        for role, duration in profile_report['roles'].items()
+                    ]
+                )
+        finally:
+            connection.close()
+        return run_id
+
+
+    def get_runs(self, action=None, host=None, limit=DEFAULT_HISTORY_LIMIT):
+        """Returns the most recent runs as a list of dicts, newest first,
+        each with its per role durations in 'roles'.
+        """
+        where  = []
+        params = []
+        if action:
+            where.append('action = ?')
+            params.append(action)
+        if host:
+            where.append("(',' || hosts || ',') LIKE ?")
+            params.append('%,{},%'.format(host))
+
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT * FROM runs {} ORDER BY id DESC LIMIT ?'.format(
+                    'WHERE ' + ' AND '.join(where) if where else ''
+                ),
+                params + [limit]
+            ).fetchall()
+            runs = [self._get_run_dict(connection, row) for row in rows]
+        finally:
+            connection.close()
+        return runs
+
+
+    def _get_run_dict(self, connection, row):
+        run = dict(row)
+        run['hosts']    = run['hosts'].split(',') if run['hosts'] else []
+        run['versions'] = json.loads(run['versions'] or '{}')
+        run['roles'] = {
+            role_row['role']: role_row['duration']
+            for role_row in connection.execute(
+                'SELECT role, duration FROM run_roles WHERE run_id = ?',
+                (run['id'],)
+            )
+        }
+        return run
+
+
+    def find_regressions(self, run,
+            window=DEFAULT_HISTORY_WINDOW,
+            threshold=DEFAULT_REGRESSION_THRESHOLD,
+            min_seconds=DEFAULT_REGRESSION_MIN_SECONDS):
+        """Compares each role of run with the median duration of the
+        same role in the last window successful runs before it, with the
+        same action and the same hosts. Returns a list of dicts for the
+        roles that were more than threshold (0.25 = 25%) and more than
+        min_seconds slower than that median. Roles with fewer than
+        DEFAULT_HISTORY_MIN_SAMPLES earlier runs are not judged.
+        """
+        connection = self._connect()
+        try:
+            previous_ids = [
+                row['id'] for row in connection.execute(
+                    """
+                    SELECT id FROM runs
+                    WHERE action = ? AND hosts = ? AND rc = 0 AND id < ?
+                    ORDER BY id DESC LIMIT ?
+                    """,
+                    (run['action'], ','.join(run['hosts']), run['id'], window)
+                )
+            ]
+            durations = {}
+            if previous_ids:
+                for row in connection.execute(
+                    'SELECT role, duration FROM run_roles WHERE run_id IN ({})'
+                        .format(','.join('?' * len(previous_ids))),
+                    previous_ids
+                ):
+                    durations.setdefault(row['role'], []).append(
+                        row['duration'])
+        finally:
+            connection.close()
+
+        regressions = []
+        for role, duration in run['roles'].items():
+            samples = durations.get(role, [])
+            if len(samples) < DEFAULT_HISTORY_MIN_SAMPLES:
+                continue
+            baseline = median(samples)
+            if duration > baseline * (1 + threshold) \
+                    and duration - baseline > min_seconds:
+                regressions.append({
+                    'role':     role,
+                    'duration': duration,
+                    'median':   baseline,
+                    'increase': (duration - baseline) / baseline
+                        if baseline else None,
+                })
+        return regressions
+
+
+def print_run_history(history, runs,
+        window=DEFAULT_HISTORY_WINDOW,
+        threshold=DEFAULT_REGRESSION_THRESHOLD):
+    if not runs:
+        print('No runs recorded in {} yet.'.format(history.path))
+        return
+
+    for run in runs:
+        print('#{:<5} {}  {:<10} rc={:<3} {:>8.1f}s  changed={:<4} {}'.format(
+            run['id'],
+            (run['started'] or '')[:19],
+            run['action'],
+            run['rc'],
+            run['total_duration'] or 0,
+            run['changed'],
+            ', '.join(run['hosts'])
+        ))
+        for regression in history.find_regressions(
+            run,
+            window=window,
+            threshold=threshold
+        ):
+            print('       REGRESSED: {} took {:.1f}s, median {:.1f}s{}'.format(
+                regression['role'] or '(no role)',
+                regression['duration'],
+                regression['median'],
+                ' (+{:.0%})'.format(regression['increase'])
+                    if regression['increase'] is not None else ''
+            ))
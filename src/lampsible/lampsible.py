@@ -1,23 +1,59 @@
 import os
+import re
+import json
+import asyncio
+from glob import glob
+from hashlib import sha256
+from sys import path as sys_path
 from copy import deepcopy
+from datetime import datetime
+from importlib.metadata import version, PackageNotFoundError
+from sqlite3 import Error as SQLiteError
+from queue import Queue, Full
+from shutil import rmtree
+from tempfile import mkdtemp
 from textwrap import dedent
+from threading import Lock, Thread
+from weakref import finalize
 from yaml import safe_load
+from packaging.version import Version, InvalidVersion
 from ansible_runner import (
     Runner, RunnerConfig, run_command, run as ansible_runner_run
 )
 from ansible_directory_helper.private_data import PrivateData
 from fqdn import FQDN
+from . import __version__
 from .constants import *
+from .capacity import print_capacity_plan
+from .profiler import Profiler
+from .history import RunHistory
+from .artifact_cache import (
+    ArtifactCache, get_wordpress_artifact_source, get_joomla_artifact_source
+)
+
+
+# Several Lampsible objects might run in parallel threads, see run_many_async,
+# but they all share the same Ansible Galaxy collections path.
+_galaxy_lock = Lock()
+# Requirements that were found to be installed, keyed on the hash of the
+# requirements file and the collections paths. This only lives as long as
+# the process, so it helps when one process runs several deployments,
+# for example with run_many, not across separate CLI runs.
+_galaxy_check_cache = set()
 
 
 class Lampsible:
 
     def __init__(self, web_user, web_host, action,
-            private_data_dir=DEFAULT_PRIVATE_DATA_DIR,
+            private_data_dir=None,
             apache_server_admin=DEFAULT_APACHE_SERVER_ADMIN,
             database_username=None,
             database_name=None, database_host=None, database_system_user=None,
             database_system_host=None, php_version=DEFAULT_PHP_VERSION, site_title=DEFAULT_SITE_TITLE,
+            php_fpm=None, php_fpm_pm=None, php_fpm_max_children=None,
+            php_fpm_max_requests=DEFAULT_PHP_FPM_MAX_REQUESTS,
+            php_opcache=True, php_opcache_jit=False,
+            php_opcache_validate_timestamps=None,
             admin_username=DEFAULT_ADMIN_USERNAME, admin_email=DEFAULT_ADMIN_EMAIL,
             wordpress_version=DEFAULT_WORDPRESS_VERSION,
             wordpress_locale=DEFAULT_WORDPRESS_LOCALE,
@@ -26,21 +62,42 @@ class Lampsible:
             drupal_profile=DEFAULT_DRUPAL_PROFILE,
             app_name=None,
             app_build_path=None,
+            app_delta_upload=DEFAULT_APP_DELTA_UPLOAD,
+            app_delta_basis=None,
             ssl_certbot=True,
-            ssl_selfsigned=False, remote_sudo_password=None,
+            ssl_selfsigned=False, ssl_key_type=DEFAULT_SSL_KEY_TYPE,
+            ssl_dh_group=DEFAULT_SSL_DH_GROUP, remote_sudo_password=None,
             ssh_key_file=None, apache_vhost_name=DEFAULT_APACHE_VHOST_NAME,
             apache_document_root=DEFAULT_APACHE_DOCUMENT_ROOT, database_password=None,
-            database_table_prefix=DEFAULT_DATABASE_TABLE_PREFIX, php_extensions=[],
-            composer_packages=[], composer_working_directory=None,
-            composer_project=None, admin_password=None,
+            database_table_prefix=DEFAULT_DATABASE_TABLE_PREFIX, php_extensions=None,
+            composer_packages=None, composer_working_directory=None,
+            composer_project=None,
+            composer_cache_dir=DEFAULT_COMPOSER_CACHE_DIR,
+            composer_no_dev=True, composer_optimize_autoloader=True,
+            composer_classmap_authoritative=False,
+            admin_password=None,
             wordpress_insecure_allow_xmlrpc=False,
+            wordpress_object_cache=None,
+            page_cache=False, page_cache_ttl=DEFAULT_PAGE_CACHE_TTL,
             app_local_env=False,
             laravel_artisan_commands=DEFAULT_LARAVEL_ARTISAN_COMMANDS,
             email_for_ssl=None,
-            domains_for_ssl=[], ssl_test_cert=False,
-            extra_packages=[], extra_env_vars={},
+            domains_for_ssl=None, ssl_test_cert=False,
+            extra_packages=None, extra_env_vars=None,
             apache_custom_conf_name='',
             ansible_galaxy_ok=False,
+            forks=None,
+            serial=DEFAULT_SERIAL,
+            parallel_database=True,
+            incremental=False,
+            fact_cache_dir=DEFAULT_FACT_CACHE_DIR,
+            fact_cache_ttl=DEFAULT_FACT_CACHE_TTL,
+            ssh_pipelining=DEFAULT_SSH_PIPELINING,
+            ssh_control_persist=DEFAULT_SSH_CONTROL_PERSIST,
+            ssh_timeout=DEFAULT_SSH_TIMEOUT,
+            profile_dir=DEFAULT_PROFILE_DIR,
+            history_file=DEFAULT_HISTORY_FILE,
+            artifact_cache_dir=DEFAULT_ARTIFACT_CACHE_DIR,
             # TODO: Lots of room for improvement for this one.
             # For now, just adding it so we can keep the interactive prompt
             # about installing missing Galaxy Collections, otherwise, it would
@@ -51,26 +108,77 @@ class Lampsible:
             ):
 
         self.web_user = web_user
-        self.web_host = web_host
+        # Both web_host and database_system_host can also be lists of hosts,
+        # in which case all of them are deployed in a single run ("fleet mode").
+        # Names that end up in the web server's configuration, like the
+        # Apache ServerName or the Certbot domains, are worked out per host,
+        # see get_server_name and friends.
+        self.web_hosts = self._to_host_list(web_host)
+        self.web_host  = self.web_hosts[0]
 
         if database_system_user:
             self.database_system_user = database_system_user
         else:
             self.database_system_user = self.web_user
         if database_system_host:
-            self.database_system_host = database_system_host
+            self.database_system_hosts = self._to_host_list(
+                database_system_host)
         else:
-            self.database_system_host = self.web_host
+            self.database_system_hosts = self.web_hosts
+        self.database_system_host = self.database_system_hosts[0]
+
+        # Every Lampsible object gets its own private data directory,
+        # so that several of them can run alongside each other.
+        if not private_data_dir:
+            os.makedirs(DEFAULT_PRIVATE_DATA_DIR, exist_ok=True)
+            private_data_dir = mkdtemp(
+                prefix='run-',
+                dir=DEFAULT_PRIVATE_DATA_DIR
+            )
+            # A run removes it when it's done, but objects that never run
+            # would leave it behind, so it's also removed once this object
+            # is garbage collected, or when the interpreter exits.
+            finalize(self, rmtree, private_data_dir, True)
+        self.private_data_dir = private_data_dir
 
         self.private_data_helper = PrivateData(private_data_dir)
         self._init_inventory()
 
         self.runner_config = RunnerConfig(
             private_data_dir=private_data_dir,
-            project_dir=PROJECT_DIR,
+            project_dir=find_package_project_dir(),
         )
 
-        self.runner = Runner(config=self.runner_config)
+        self.forks  = forks
+        self.serial = serial
+        self.parallel_database = parallel_database
+        self.incremental       = incremental
+
+        self.fact_cache_dir = fact_cache_dir
+        self.fact_cache_ttl = fact_cache_ttl
+
+        self.ssh_pipelining      = ssh_pipelining
+        self.ssh_control_persist = ssh_control_persist
+        self.ssh_timeout         = ssh_timeout
+        self.profile_dir         = profile_dir
+        self.profile_report      = None
+        self.profile_report_path = None
+        self.history_file        = history_file
+        self.history_run_id      = None
+        self.artifact_cache_dir  = artifact_cache_dir
+        self.rc = None
+        self.host_stats = {}
+        self.plan_summary = {}
+        self.capacity_plans = {}
+
+        self.event_callback = None
+        self._current_task = None
+        self._cancel_requested = False
+        self.runner = Runner(
+            config=self.runner_config,
+            event_handler=self._handle_event,
+            cancel_callback=lambda: self._cancel_requested
+        )
 
         self.apache_document_root = apache_document_root
         self.apache_vhost_name    = apache_vhost_name
@@ -79,8 +187,10 @@ class Lampsible:
         self.ssl_certbot     = ssl_certbot
         self.ssl_test_cert   = ssl_test_cert
         self.ssl_selfsigned  = ssl_selfsigned
+        self.ssl_key_type    = ssl_key_type
+        self.ssl_dh_group    = ssl_dh_group
         self.email_for_ssl   = email_for_ssl
-        self.domains_for_ssl = domains_for_ssl
+        self.domains_for_ssl = list(domains_for_ssl or [])
 
         self.apache_custom_conf_name = apache_custom_conf_name
 
@@ -91,10 +201,26 @@ class Lampsible:
         self.database_table_prefix = database_table_prefix
 
         self.php_version                = php_version
-        self.php_extensions             = php_extensions
-        self.composer_packages          = composer_packages
+        self.php_extensions             = list(php_extensions or [])
+        self.php_fpm                    = php_fpm
+        self.php_fpm_pm                 = php_fpm_pm
+        self.php_fpm_max_children       = php_fpm_max_children
+        self.php_fpm_max_requests       = php_fpm_max_requests
+        self.php_opcache                = php_opcache
+        self.php_opcache_jit            = php_opcache_jit
+        self.php_opcache_validate_timestamps = \
+            php_opcache_validate_timestamps
+        self.composer_packages          = list(composer_packages or [])
         self.composer_project           = composer_project
         self.composer_working_directory = composer_working_directory
+        self.composer_cache_dir         = composer_cache_dir
+
+        self.composer_no_dev                 = composer_no_dev
+        self.composer_optimize_autoloader    = composer_optimize_autoloader
+        self.composer_classmap_authoritative = composer_classmap_authoritative
+
+        # Adds to php_extensions, see set_action.
+        self.wordpress_object_cache = wordpress_object_cache
 
         self.set_action(action)
 
@@ -107,6 +233,9 @@ class Lampsible:
         self.wordpress_locale  = wordpress_locale
         self.wordpress_insecure_allow_xmlrpc  = wordpress_insecure_allow_xmlrpc
 
+        self.page_cache     = page_cache
+        self.page_cache_ttl = page_cache_ttl
+
         self.joomla_version = joomla_version
         self.joomla_admin_full_name = joomla_admin_full_name
 
@@ -114,10 +243,12 @@ class Lampsible:
 
         self.app_name = app_name
         self.app_build_path = app_build_path
-        self.laravel_artisan_commands = laravel_artisan_commands
+        self.app_delta_upload = app_delta_upload
+        self.app_delta_basis = app_delta_basis
+        self.laravel_artisan_commands = list(laravel_artisan_commands)
         self.app_local_env = app_local_env
-        self.extra_packages = extra_packages
-        self.extra_env_vars = extra_env_vars
+        self.extra_packages = list(extra_packages or [])
+        self.extra_env_vars = dict(extra_env_vars or {})
 
         if ssh_key_file:
             try:
@@ -149,6 +280,11 @@ class Lampsible:
         if action == 'wordpress':
             if self.database_table_prefix == DEFAULT_DATABASE_TABLE_PREFIX:
                 self.database_table_prefix = 'wp_'
+            if self.wordpress_object_cache:
+                required_php_extensions.append('php-{}'.format(
+                    WORDPRESS_OBJECT_CACHES[self.wordpress_object_cache][
+                        'php_extension']
+                ))
         elif action == 'drupal':
             if not self.composer_project:
                 self.composer_project = 'drupal/recommended-project'
@@ -199,18 +335,15 @@ class Lampsible:
             if self.apache_vhost_name == DEFAULT_APACHE_VHOST_NAME:
                 self.apache_vhost_name = self.app_name
 
-        if FQDN(self.web_host).is_valid:
-            server_name = self.web_host
-        else:
-            server_name = DEFAULT_APACHE_SERVER_NAME
-
         base_vhost_dict = {
             'base_vhost_file': '{}.conf'.format(DEFAULT_APACHE_VHOST_NAME),
             'document_root':  self.apache_document_root,
             'vhost_name':     self.apache_vhost_name,
-            'server_name':    server_name,
             'server_admin':   self.apache_server_admin,
             'allow_override': self.get_apache_allow_override(),
+            'php_fpm_socket': self.get_php_fpm_pool()['socket']
+                if self.uses_php_fpm() else '',
+            'page_cache':     self.get_page_cache(),
         }
 
         self.apache_vhosts = [base_vhost_dict]
@@ -218,8 +351,6 @@ class Lampsible:
         if self.ssl_certbot:
             if not self.email_for_ssl:
                 self.email_for_ssl = self.apache_server_admin
-            if not self.domains_for_ssl:
-                self.domains_for_ssl = [self.web_host]
 
         elif self.ssl_selfsigned:
             ssl_vhost_dict = deepcopy(base_vhost_dict)
@@ -236,6 +367,29 @@ class Lampsible:
             self.composer_working_directory = self.apache_document_root
 
 
+    def get_server_name(self, host):
+        if FQDN(host).is_valid:
+            return host
+        return DEFAULT_APACHE_SERVER_NAME
+
+
+    def get_wordpress_url(self, host):
+        if not self.ssl_certbot or host[:4] == 'www.':
+            return host
+        return 'www.{}'.format(host)
+
+
+    def get_certbot_domains(self, host):
+        # Explicit domains are requested on every web server. Otherwise,
+        # each one asks for a certificate for its own name.
+        domains = list(self.domains_for_ssl) or [host]
+        if self.action == 'wordpress':
+            wordpress_url = self.get_wordpress_url(host)
+            if wordpress_url not in domains:
+                domains.append(wordpress_url)
+        return domains
+
+
     def get_apache_allow_override(self):
         return (
             self.action in ['laravel', 'drupal']
@@ -247,27 +401,215 @@ class Lampsible:
         )
 
 
+    def uses_php_fpm(self):
+        if self.action not in PHP_FPM_ACTIONS + ['lamp-stack']:
+            return False
+        if self.php_fpm is None:
+            return self.action in PHP_FPM_ACTIONS
+        return self.php_fpm
+
+
+    def get_php_fpm_pool(self):
+        """Returns the PHP-FPM pool of the site. Settings that are None
+        are computed on each host, from its capacity plan, see capacity.py.
+        """
+        return {
+            'name':         self.apache_vhost_name,
+            'socket':       PHP_FPM_SOCKET.format(self.apache_vhost_name),
+            'pm':           self.php_fpm_pm,
+            'max_children': self.php_fpm_max_children,
+            'max_requests': self.php_fpm_max_requests,
+        }
+
+
+    def get_page_cache(self):
+        """Returns the full-page cache settings of the site's virtual hosts,
+        or an empty dict, if it doesn't have a page cache.
+        """
+        if not self.page_cache or self.action not in PAGE_CACHE_ACTIONS:
+            return {}
+        bypass = PAGE_CACHE_BYPASS[self.action]
+        return {
+            'root':           APACHE_PAGE_CACHE_ROOT,
+            'ttl':            self.page_cache_ttl,
+            'bypass_cookies': r'(^|;\s*)({})'.format(
+                '|'.join(bypass['cookies'])),
+            'bypass_paths':   bypass['paths'],
+        }
+
+
+    def get_wordpress_object_cache(self):
+        """Returns the object cache of the WordPress site,
+        or an empty dict, if it doesn't have one.
+        """
+        if self.action != 'wordpress' or not self.wordpress_object_cache:
+            return {}
+        object_cache = dict(
+            WORDPRESS_OBJECT_CACHES[self.wordpress_object_cache])
+        object_cache['name'] = self.wordpress_object_cache
+        # Keeps sites that share the cache server apart.
+        object_cache['key_salt'] = '{}:'.format(self.apache_vhost_name)
+        return object_cache
+
+
+    def uses_php_opcache(self):
+        return bool(self.php_opcache) and self.action in [
+            'wordpress',
+            'joomla',
+            'drupal',
+            'laravel',
+        ]
+
+
+    def get_php_opcache_app(self):
+        """Returns what the php-opcache role needs to know about the app."""
+        if self.action == 'laravel':
+            app_root = '{}/{}'.format(
+                DEFAULT_APACHE_DOCUMENT_ROOT,
+                self.app_name
+            )
+        elif self.action == 'drupal':
+            app_root = self.composer_working_directory
+        else:
+            app_root = self.apache_document_root
+
+        if self.php_opcache_validate_timestamps is not None:
+            validate_timestamps = self.php_opcache_validate_timestamps
+        else:
+            validate_timestamps = (
+                self.action not in PHP_OPCACHE_NO_VALIDATE_ACTIONS
+                or self.app_local_env
+            )
+
+        return {
+            'name':                self.apache_vhost_name,
+            'root':                app_root,
+            'validate_timestamps': validate_timestamps,
+            'jit':                 self.php_opcache_jit,
+            'preload_paths': [
+                '{}/{}'.format(app_root, path)
+                for path in PHP_OPCACHE_PRELOAD_PATHS.get(self.action, [])
+            ],
+        }
+
+
+    def get_apt_packages(self):
+        try:
+            required_packages = REQUIRED_APT_PACKAGES[self.action]
+        except KeyError:
+            required_packages = {}
+
+        apt_packages = {
+            group: list(required_packages.get(group, []))
+            for group in ['web_servers', 'database_servers']
+        }
+
+        if self.action in [
+            'lamp-stack',
+            'php',
+            'wordpress',
+            'joomla',
+            'drupal',
+            'laravel',
+        ]:
+            apt_packages['web_servers'].append('php{}'.format(
+                self.php_version or ''
+            ))
+            if self.uses_php_fpm():
+                # Satisfies the 'php' package's dependency on a SAPI,
+                # so that APT doesn't pull in mod_php.
+                apt_packages['web_servers'].append('php{}-fpm'.format(
+                    self.php_version or ''
+                ))
+            apt_packages['web_servers'].extend(self.php_extensions)
+            if self.composer_packages or self.composer_project:
+                apt_packages['web_servers'].append('composer')
+
+        object_cache = self.get_wordpress_object_cache()
+        if object_cache:
+            apt_packages['web_servers'].append(object_cache['server'])
+
+        return apt_packages
+
+
+    def get_capacity_tiers(self):
+        # What the capacity plan makes room for on each host depends on
+        # what this action installs there, not just on the host's groups.
+        # For example, with the action 'mysql' on a single host,
+        # that host is a web server too, but there's no Apache or PHP.
+        apt_packages = self.get_apt_packages()
+        php = any(
+            package.startswith('php')
+            for package in apt_packages['web_servers']
+        )
+        web = php or 'apache2' in apt_packages['web_servers']
+        database = 'mysql-server' in apt_packages['database_servers']
+        return {
+            host: {
+                'web':      web and host in self.web_hosts,
+                'php':      php and host in self.web_hosts,
+                'database': database and host in self.database_system_hosts,
+            }
+            for host in self.get_all_hosts()
+        }
+
+
+    def get_extra_apt_packages(self):
+        # Extra packages go onto the web servers, unless the action
+        # doesn't have any, like 'mysql'.
+        if 'web_servers' in REQUIRED_APT_PACKAGES.get(self.action, {}):
+            extra_packages_group = 'web_servers'
+        else:
+            extra_packages_group = 'database_servers'
+
+        extra_apt_packages = {
+            'web_servers':      [],
+            'database_servers': [],
+        }
+        extra_apt_packages[extra_packages_group] = self.extra_packages
+        return extra_apt_packages
+
+
     def print_banner(self):
         print(self.banner)
 
 
+    def _to_host_list(self, hosts):
+        if isinstance(hosts, str):
+            return [hosts]
+        hosts = list(hosts)
+        if not hosts:
+            raise ValueError('Got an empty list of hosts.')
+        return hosts
+
+
+    def get_all_hosts(self):
+        return list(dict.fromkeys(
+            self.web_hosts + self.database_system_hosts
+        ))
+
+
     def _init_inventory(self):
         self.private_data_helper.add_inventory_groups([
             'web_servers',
             'database_servers',
         ])
-        self.private_data_helper.add_inventory_host(self.web_host, 'web_servers')
-        self.private_data_helper.add_inventory_host(self.database_system_host,
+        for host in self.web_hosts:
+            self.private_data_helper.add_inventory_host(host, 'web_servers')
+            self.private_data_helper.set_inventory_ansible_user(host,
+                self.web_user)
+        for host in self.database_system_hosts:
+            self.private_data_helper.add_inventory_host(host,
                 'database_servers')
-        self.private_data_helper.set_inventory_ansible_user(self.web_host, self.web_user)
-        self.private_data_helper.set_inventory_ansible_user(
-                self.database_system_host, self.database_system_user)
+            self.private_data_helper.set_inventory_ansible_user(host,
+                self.database_system_user)
         self.private_data_helper.write_inventory()
 
 
-    def _update_env(self):
+    def _update_env(self, check=False):
         extravars = [
             'web_host',
+            'server_names',
             'apache_vhosts',
             'apache_vhost_name',
             'apache_document_root',
@@ -284,9 +626,20 @@ class Lampsible:
             'database_table_prefix',
             'php_version',
             'php_extensions',
+            'lampsible_action',
+            'capacity_tiers',
+            'page_cache',
+            'php_fpm',
+            'php_fpm_pool',
+            'php_opcache',
+            'php_opcache_app',
             'composer_packages',
             'composer_project',
             'composer_working_directory',
+            'composer_cache_dir',
+            'composer_no_dev',
+            'composer_optimize_autoloader',
+            'composer_classmap_authoritative',
             'site_title',
             'admin_username',
             'admin_password',
@@ -297,13 +650,19 @@ class Lampsible:
             extravars.extend([
                 'wordpress_version',
                 'wordpress_locale',
-                'wordpress_url',
+                'wordpress_urls',
                 'wordpress_insecure_allow_xmlrpc',
+                'wordpress_object_cache',
+                'wp_cli_artifact',
+                'wordpress_core_artifact',
+                'remote_artifact_dir',
             ])
         elif self.action == 'joomla':
             extravars.extend([
                 'joomla_version',
                 'joomla_admin_full_name',
+                'joomla_artifact',
+                'remote_artifact_dir',
             ])
         elif self.action == 'drupal':
             extravars.extend([
@@ -314,6 +673,9 @@ class Lampsible:
                 'app_name',
                 'app_build_path',
                 'app_source_root',
+                'app_delta_upload',
+                'app_delta_basis',
+                'app_checksum_file',
                 'laravel_artisan_commands',
                 'app_local_env',
             ])
@@ -321,36 +683,49 @@ class Lampsible:
         extravars.extend([
             'ssl_certbot',
             'email_for_ssl',
-            'certbot_domains_string',
+            'certbot_domains',
             'ssl_test_cert',
             'ssl_selfsigned',
-            'extra_packages',
+            'ssl_key_type',
+            'ssl_dh_group',
+            'apt_packages',
+            'extra_apt_packages',
             'extra_env_vars',
             # TODO: This one especially... use Ansible Runner's
             # dedicated password feature, that is, we should add it
             # ansible-directory-helper.
             'ansible_sudo_pass',
             'open_database',
+            'serial',
+            'parallel_database',
+            'incremental',
         ])
 
-        for varname in extravars:
-            if varname == 'server_name':
-                if FQDN.is_valid(self.web_host):
-                    value = self.web_host
-                else:
-                    value = DEFAULT_APACHE_SERVER_NAME
-
-            elif varname == 'wordpress_url':
-                if not self.ssl_certbot or self.web_host[:4] == 'www.':
-                    value = self.web_host
-                else:
-                    value = 'www.{}'.format(self.web_host)
-
-                if value not in self.domains_for_ssl:
-                    self.domains_for_ssl.append(value)
+        extravar_values = {}
+        # A plan shouldn't download anything.
+        artifacts = self.get_artifacts(fetch=not check)
 
-            elif varname == 'certbot_domains_string':
-                value = '-d {}'.format(' -d '.join(self.domains_for_ssl))
+        for varname in extravars:
+            # In fleet mode, every web server gets its own names, so these
+            # are dictionaries keyed by inventory_hostname.
+            if varname == 'server_names':
+                value = {
+                    host: self.get_server_name(host)
+                    for host in self.web_hosts
+                }
+
+            elif varname == 'wordpress_urls':
+                value = {
+                    host: self.get_wordpress_url(host)
+                    for host in self.web_hosts
+                }
+
+            elif varname == 'certbot_domains':
+                value = {
+                    host: '-d {}'.format(' -d '.join(
+                        self.get_certbot_domains(host)))
+                    for host in self.web_hosts
+                }
 
             # This lets us pass extra_env_vars to Lampsible in the more sensible dictionary format,
             # while still using them in the more convenient list format.
@@ -370,14 +745,58 @@ class Lampsible:
                         'laravel_extra_env_vars',
                         value
                     )
+                    extravar_values['laravel_extra_env_vars'] = value
                     value = []
 
+            elif varname == 'apt_packages':
+                value = self.get_apt_packages()
+
+            elif varname == 'extra_apt_packages':
+                value = self.get_extra_apt_packages()
+
+            elif varname in artifacts:
+                value = artifacts[varname]
+
+            elif varname == 'remote_artifact_dir':
+                value = REMOTE_ARTIFACT_DIR
+
             elif varname == 'app_source_root':
                 value = '{}/{}'.format(
                     DEFAULT_APACHE_DOCUMENT_ROOT,
                     self.app_name
                 )
 
+            elif varname == 'lampsible_action':
+                # Not just 'action', which Ansible reserves.
+                value = self.action
+
+            elif varname == 'capacity_tiers':
+                value = self.get_capacity_tiers()
+
+            elif varname == 'php_fpm':
+                value = self.uses_php_fpm()
+
+            elif varname == 'php_fpm_pool':
+                value = self.get_php_fpm_pool()
+
+            elif varname == 'page_cache':
+                value = self.get_page_cache()
+
+            elif varname == 'wordpress_object_cache':
+                value = self.get_wordpress_object_cache()
+
+            elif varname == 'php_opcache':
+                value = self.uses_php_opcache()
+
+            elif varname == 'php_opcache_app':
+                value = self.get_php_opcache_app()
+
+            elif varname == 'app_checksum_file':
+                value = '{}/{}.json'.format(
+                    REMOTE_APP_CHECKSUM_DIR,
+                    self.app_name
+                )
+
             elif varname == 'ansible_sudo_pass':
                 if self.remote_sudo_password:
                     value = self.remote_sudo_password
@@ -385,55 +804,297 @@ class Lampsible:
                     continue
 
             elif varname == 'open_database':
-                if self.database_system_host is None \
-                        or self.database_system_host == self.web_host:
-                    value = False
-                else:
-                    value = True
+                value = set(self.database_system_hosts) != set(self.web_hosts)
+
+            # Database servers and web servers can only be prepared alongside
+            # each other if none of the hosts is both.
+            elif varname == 'parallel_database':
+                value = bool(self.parallel_database) and set(
+                    self.database_system_hosts
+                ).isdisjoint(self.web_hosts)
 
             else:
                 value = getattr(self, varname)
 
             self.private_data_helper.set_extravar(varname, value)
+            extravar_values[varname] = value
 
+        self.private_data_helper.set_extravar(
+            'role_hashes',
+            self.get_role_hashes(extravar_values)
+        )
         self.private_data_helper.write_env()
 
 
+    def get_artifacts(self, fetch=True):
+        """Returns the artifacts that the current action's roles need,
+        keyed on the name of their extravar, see ArtifactCache.get.
+        Unless self.artifact_cache_dir is None, they are fetched onto
+        the controller first, or, unless fetch is True, taken from there
+        if they were fetched before.
+        """
+        sources = {}
+        if self.action == 'wordpress':
+            sources['wp_cli_artifact'] = ('wp-cli.phar', WP_CLI_DOWNLOAD_URL,
+                True, WP_CLI_CHECKSUM)
+            sources['wordpress_core_artifact'] = get_wordpress_artifact_source(
+                self.wordpress_version,
+                self.wordpress_locale
+            )
+        elif self.action == 'joomla':
+            sources['joomla_artifact'] = get_joomla_artifact_source(
+                self.joomla_version)
+
+        artifacts = {}
+        for varname, source in sources.items():
+            if source is None:
+                artifacts[varname] = {
+                    'name': '', 'url': '', 'checksum': '', 'src': ''}
+            elif self.artifact_cache_dir is None:
+                name, url, moving, checksum = source
+                artifacts[varname] = {
+                    'name': name, 'url': url, 'checksum': checksum, 'src': ''}
+            else:
+                artifacts[varname] = ArtifactCache(
+                    self.artifact_cache_dir).get(*source, fetch=fetch)
+        return artifacts
+
+
+    def get_role_hashes(self, extravars):
+        """Returns a dictionary with a hash for each role, which changes
+        whenever the role itself, or any of the extravars that it uses,
+        change. Incremental runs compare these to the hashes that are
+        stored on each host, and skip those roles that are up to date.
+        """
+        roles_dir = os.path.join(find_package_project_dir(), 'roles')
+        role_hashes = {}
+        for role in sorted(os.listdir(roles_dir)):
+            role_hash = sha256()
+            role_text = ''
+            for dirpath, dirnames, filenames in sorted(os.walk(
+                os.path.join(roles_dir, role)
+            )):
+                # Python writes bytecode next to a role's modules or plugins
+                # whenever they're imported, which mustn't change the hash.
+                if '__pycache__' in dirpath.split(os.sep):
+                    continue
+                for filename in sorted(filenames):
+                    if filename.endswith(('.pyc', '.pyo')):
+                        continue
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        role_data = f.read()
+                    role_hash.update(role_data)
+                    role_text += role_data.decode(errors='ignore')
+
+            # A variable counts as input of a role,
+            # if its name appears anywhere in the role.
+            role_words = set(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', role_text))
+            role_inputs = {
+                varname: value for varname, value in extravars.items()
+                if varname in role_words
+            }
+            # The build archive might change, while its path stays the same.
+            if 'app_build_path' in role_inputs and role_inputs['app_build_path']:
+                try:
+                    build_stat = os.stat(role_inputs['app_build_path'])
+                    role_inputs['app_build_path'] = [
+                        role_inputs['app_build_path'],
+                        build_stat.st_size,
+                        build_stat.st_mtime,
+                    ]
+                except FileNotFoundError:
+                    pass
+
+            role_hash.update(json.dumps(
+                role_inputs,
+                sort_keys=True,
+                default=str
+            ).encode())
+            role_hashes[role] = role_hash.hexdigest()
+
+        return role_hashes
+
+
+    def get_ansible_envvars(self):
+        envvars = {}
+        if self.fact_cache_ttl:
+            # Only gather facts for hosts that aren't in the cache yet,
+            # or whose cached facts have expired.
+            envvars['ANSIBLE_GATHERING']            = 'smart'
+            envvars['ANSIBLE_CACHE_PLUGIN_TIMEOUT'] = self.fact_cache_ttl
+
+        # Pipelining runs modules without uploading them to a temporary file
+        # first, and ControlPersist lets all tasks on a host share a single
+        # SSH connection, so tasks don't have to pay for those round trips.
+        envvars['ANSIBLE_PIPELINING'] = self.ssh_pipelining
+        envvars['ANSIBLE_TIMEOUT']    = self.ssh_timeout
+        if self.ssh_control_persist:
+            envvars['ANSIBLE_SSH_ARGS'] = \
+                '-C -o ControlMaster=auto -o ControlPersist={}'.format(
+                    self.ssh_control_persist
+                )
+            envvars['ANSIBLE_SSH_CONTROL_PATH_DIR'] = os.path.join(
+                os.path.abspath(self.private_data_dir),
+                'cp'
+            )
+        else:
+            envvars['ANSIBLE_SSH_ARGS'] = '-C -o ControlMaster=no'
+
+        return envvars
+
+
+    def _prepare_fact_cache(self):
+        os.makedirs(self.fact_cache_dir, mode=0o700, exist_ok=True)
+        # Ansible Runner joins this with its artifact directory,
+        # which is fine, because it's an absolute path.
+        self.runner_config.fact_cache = os.path.abspath(self.fact_cache_dir)
+
+
     def _prepare_config(self):
+        self._prepare_fact_cache()
+        self.runner_config.envvars = self.get_ansible_envvars()
+        if self.forks:
+            self.runner_config.forks = self.forks
+        else:
+            self.runner_config.forks = min(
+                len(self.get_all_hosts()),
+                MAX_DEFAULT_FORKS
+            )
         self.runner_config.prepare()
 
 
+    def _collect_host_stats(self):
+        self.host_stats = self._get_host_stats_from(self.runner.stats or {})
+
+
+    def _get_host_stats_from(self, stats):
+        return {
+            host: {
+                key: stats.get(key, {}).get(host, 0)
+                for key in [
+                    'ok',
+                    'changed',
+                    'skipped',
+                    'failures',
+                    'dark',
+                    'ignored',
+                    'rescued',
+                ]
+            } for host in self.get_all_hosts()
+        }
+
+
+    def get_host_stats(self):
+        return self.host_stats
+
+
+    def get_failed_hosts(self):
+        return [
+            host for host, stats in self.host_stats.items()
+            if stats['failures'] > 0 or stats['dark'] > 0
+        ]
+
+
+    def print_host_stats(self):
+        for host, stats in self.host_stats.items():
+            print('{}: {}'.format(
+                host,
+                ', '.join([
+                    '{}={}'.format(key, val) for key, val in stats.items()
+                ])
+            ))
+        failed_hosts = self.get_failed_hosts()
+        if failed_hosts:
+            print('\nWarning! The run failed on these hosts:\n- {}'.format(
+                '\n- '.join(failed_hosts)
+            ))
+
+
     def _ensure_galaxy_dependencies(self):
-        with open(GALAXY_REQUIREMENTS_FILE, 'r') as stream:
-            required_collections = []
-            tmp_collections = safe_load(stream)['collections']
-            for tmp_dict in tmp_collections:
-                required_collections.append(tmp_dict['name'])
-
-        # TODO There might be a more elegant way to do this - Right now,
-        # we're expecting required_collections to always be a tuple,
-        # and searching for requirements in a big string, but yaml/dict
-        # would be better.
-        installed_collections = run_command(
-            executable_cmd='ansible-galaxy',
-            cmdline_args=[
-                'collection',
-                'list',
-                '--collections-path',
-                os.path.join(USER_HOME_DIR, '.ansible'),
-            ],
-            quiet=True
-        )[0]
-        missing_collections = []
-        for required in required_collections:
-            if required not in installed_collections:
-                missing_collections.append(required)
+        with open(get_galaxy_requirements_file(), 'rb') as stream:
+            requirements_data = stream.read()
+
+        collections_paths = self._get_collections_paths()
+        cache_key = (
+            sha256(requirements_data).hexdigest(),
+            tuple(collections_paths),
+        )
+        if cache_key in _galaxy_check_cache:
+            return 0
+
+        required_collections = [
+            tmp_dict['name']
+            for tmp_dict in safe_load(requirements_data)['collections']
+        ]
+        missing_collections = [
+            required for required in required_collections
+            if not self._is_galaxy_collection_installed(
+                required,
+                collections_paths
+            )
+        ]
         if len(missing_collections) == 0:
+            _galaxy_check_cache.add(cache_key)
             return 0
         else:
             return self._install_galaxy_collections(missing_collections)
 
 
+    def _get_collections_paths(self):
+        # The same places where Ansible itself looks for collections,
+        # that is, ANSIBLE_COLLECTIONS_PATH or ansible.cfg if set, otherwise
+        # ~/.ansible/collections and /usr/share/ansible/collections,
+        # and sys.path. Imported here, because loading Ansible's
+        # configuration slows down the CLI's startup.
+        from ansible import constants as C
+        collections_paths = list(C.COLLECTIONS_PATHS)
+        if C.COLLECTIONS_SCAN_SYS_PATH:
+            collections_paths.extend(sys_path)
+        return collections_paths
+
+
+    def _is_galaxy_collection_installed(self, collection, collections_paths):
+        # Looks for the collection's metadata directly on the file system,
+        # instead of asking 'ansible-galaxy collection list'.
+        namespace, name = collection.split('.')
+        for path_str in collections_paths:
+            # Like Ansible, accept paths that point at the
+            # 'ansible_collections' directory itself.
+            if os.path.basename(os.path.normpath(path_str)) \
+                    != 'ansible_collections':
+                path_str = os.path.join(path_str, 'ansible_collections')
+            if os.path.isfile(os.path.join(
+                path_str,
+                namespace,
+                name,
+                'MANIFEST.json'
+            )):
+                return True
+        return False
+
+
+    def _find_vendored_collection(self, collection):
+        # Picks the newest tarball, comparing versions rather than
+        # file names, so that 10.2.0 wins over 9.5.0.
+        prefix = '{}-'.format(collection.replace('.', '-'))
+        newest_path    = None
+        newest_version = None
+        for path_str in glob(os.path.join(
+            get_vendored_collections_dir(),
+            '{}*.tar.gz'.format(prefix)
+        )):
+            try:
+                tarball_version = Version(
+                    os.path.basename(path_str)[len(prefix):-len('.tar.gz')]
+                )
+            except InvalidVersion:
+                continue
+            if newest_version is None or tarball_version > newest_version:
+                newest_path    = path_str
+                newest_version = tarball_version
+        return newest_path
+
+
     def _install_galaxy_collections(self, collections):
         if not self.ansible_galaxy_ok:
             formatted_collections_list = '\n- '.join(collections)
@@ -466,37 +1127,464 @@ Ansible Galaxy dependencies into {}:\n- {}\nIs this OK (yes/no)?
         print('\nInstalling Ansible Galaxy collections into {} ...'.format(
             os.path.join(USER_HOME_DIR, '.ansible')
         ))
+        vendored_collections = [
+            self._find_vendored_collection(collection)
+            for collection in collections
+        ]
+        if None not in vendored_collections:
+            # Everything we need was shipped along with Lampsible,
+            # so there's no need to go online.
+            cmdline_args = ['collection', 'install', '--offline'] \
+                + vendored_collections
+        else:
+            cmdline_args = ['collection', 'install'] + [
+                vendored or collection
+                for collection, vendored in zip(
+                    collections,
+                    vendored_collections
+                )
+            ]
         run_command(
             executable_cmd='ansible-galaxy',
-            cmdline_args=['collection', 'install'] + collections,
+            cmdline_args=cmdline_args,
         )
         print('\n... collections installed.')
         return 0
 
 
-    # TODO: Do it this way?
-    #def dump_ansible_facts(self):
-    #    ansible_runner_run(
-    #        private_data_dir=self.private_data_dir,
-    #        host_pattern=self.web_host,
-    #        module='setup',
-    #        module_args='no_log=true'
-    #    )
+    def dump_ansible_facts(self):
+        # Gathers all facts, not just the subset that the playbooks need,
+        # and stores them in the fact cache, so that the next run can use them.
+        self._prepare_fact_cache()
+        runner = ansible_runner_run(
+            private_data_dir=self.private_data_dir,
+            host_pattern='all',
+            module='setup',
+            fact_cache=self.runner_config.fact_cache,
+            envvars=self.get_ansible_envvars(),
+            ssh_key=self.runner_config.ssh_key_data,
+            quiet=True,
+        )
 
+        for event in runner.events:
+            if event.get('event') != 'runner_on_ok':
+                continue
+            print('{}:\n{}\n'.format(
+                event['event_data']['host'],
+                json.dumps(
+                    event['event_data']['res'].get('ansible_facts', {}),
+                    indent=4,
+                    sort_keys=True
+                )
+            ))
 
-    def run(self):
+        self.private_data_helper.cleanup_dir()
+        return runner.rc
+
+
+    def run(self, event_callback=None, profile=False):
+        """Runs the playbook and returns its rc.
+
+        If event_callback is passed, it is called with a dict for each
+        event while the playbook is running, see _to_lampsible_event.
+        Events aren't collected in memory, so the callback should keep
+        whatever it needs.
+
+        If profile is True, the time spent in each task, role and host
+        is recorded. The report is in self.profile_report afterwards, and
+        is also written to a JSON file in self.profile_dir,
+        see self.profile_report_path.
+
+        Unless self.history_file is None, the run is also recorded in
+        that SQLite database, see RunHistory.
+        """
+        if not (profile or self.history_file):
+            return self._run_playbook(event_callback=event_callback)
+
+        profiler = Profiler(self.action)
+
+        def handle_event(event):
+            profiler.handle_event(event)
+            if event_callback:
+                event_callback(event)
+
+        rc = self._run_playbook(event_callback=handle_event)
+        self.profile_report = profiler.get_report()
+        if profile:
+            self.profile_report_path = profiler.write_report(self.profile_dir)
+        # If the playbook never started, there's nothing to compare.
+        if self.history_file and self.profile_report['started']:
+            self._add_to_history()
+        return rc
+
+
+    def _add_to_history(self):
+        try:
+            self.history_run_id = RunHistory(self.history_file).add_run(
+                action=self.action,
+                hosts=self.get_all_hosts(),
+                versions=self.get_versions(),
+                rc=self.rc,
+                host_stats=self.host_stats,
+                profile_report=self.profile_report
+            )
+        except (SQLiteError, OSError) as e:
+            print('Warning! Could not write run history: {}'.format(e))
+
+
+    def get_versions(self):
+        try:
+            ansible_core_version = version('ansible-core')
+        except PackageNotFoundError:
+            ansible_core_version = None
+        versions = {
+            'lampsible':    __version__,
+            'ansible_core': ansible_core_version,
+            'php':          self.php_version,
+        }
+        if self.action == 'wordpress':
+            versions['wordpress'] = self.wordpress_version
+        elif self.action == 'joomla':
+            versions['joomla'] = self.joomla_version
+        return versions
+
+
+    def stream(self):
+        """Like run, but returns an iterator over the events of the run,
+        see _to_lampsible_event. The run happens in a separate thread.
+        Once the iterator is exhausted, the rc is in self.rc.
+        If the iterator is closed early, for example by breaking out of
+        a for loop, the run is cancelled, see cancel, and closing returns
+        once the tasks that are already running have finished.
+        """
+        queue = Queue(maxsize=EVENT_QUEUE_SIZE)
+        done = object()
+        closed = False
+
+        def put(item):
+            while not closed:
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        def target():
+            try:
+                self.run(event_callback=put)
+            finally:
+                put(done)
+
+        thread = Thread(target=target, daemon=True)
+        thread.start()
+        event = None
+        try:
+            while (event := queue.get()) is not done:
+                yield event
+        finally:
+            closed = True
+            # Cancel until the thread is done, since a run that hasn't
+            # started its playbook yet would reset the flag.
+            while thread.is_alive():
+                if event is not done:
+                    self.cancel()
+                thread.join(timeout=0.1)
+
+
+    def cancel(self):
+        """Stops the current run, for example from an event callback,
+        after a failure on one host.
+        """
+        self._cancel_requested = True
+
+
+    def plan(self):
+        """Runs the playbook in Ansible's check and diff mode, which doesn't
+        change anything on the hosts, and returns a summary of what a real run
+        would change, for each host. See _collect_plan_summary.
+        Keep in mind that some tasks can't be checked without actually
+        running the tasks before them, for example, starting a service
+        that isn't installed yet. These show up as failed tasks.
+        """
+        self._run_playbook(check=True)
+        return self.plan_summary
+
+
+    def _run_playbook(self, check=False, event_callback=None):
+        self.event_callback = event_callback
+        self._current_task = None
+        self._cancel_requested = False
         self._set_apache_vars()
-        self._update_env()
+        self._update_env(check=check)
+        if check:
+            self.runner_config.cmdline_args = '--check --diff'
+        else:
+            self.runner_config.cmdline_args = None
         self._prepare_config()
 
         rc = 1
         try:
-            assert self._ensure_galaxy_dependencies() == 0
+            with _galaxy_lock:
+                assert self._ensure_galaxy_dependencies() == 0
             self.runner.run()
-            print(self.runner.stats)
+            self._collect_host_stats()
+            self._collect_capacity_plans()
+            if check:
+                self._collect_plan_summary()
+            else:
+                self.print_host_stats()
+                self.print_capacity_plans()
             rc = self.runner.rc
         except (AssertionError, RuntimeError):
             pass
 
         self.private_data_helper.cleanup_dir()
+        self.event_callback = None
+        self.rc = rc
         return rc
+
+
+    def _handle_event(self, event):
+        # Ansible Runner calls this for each event, as it happens,
+        # before writing the event to the artifact directory.
+        if self.event_callback:
+            for lampsible_event in self._to_lampsible_event(event):
+                try:
+                    self.event_callback(lampsible_event)
+                except Exception as e:
+                    print('Warning! Event callback failed: {}'.format(e))
+        return True
+
+
+    def _to_lampsible_event(self, event):
+        """Translates an Ansible Runner event into a list of simpler
+        Lampsible events, usually one, or none for events
+        that aren't interesting. Each event is a dict with these keys:
+
+        - type:     'play_start', 'task_start', 'task_end', 'host_result'
+                    or 'stats'.
+        - play:     Name of the play.
+        - role:     Name of the role, if any.
+        - task:     Name of the task.
+        - host:     Only for host results.
+        - status:   Only for host results. 'ok', 'changed', 'failed',
+                    'skipped' or 'unreachable'.
+        - changed:  Whether the task changed something on the host.
+        - failed:   Whether the task failed on the host, or the host
+                    was unreachable. Ignored errors don't count.
+        - msg:      Only for failed host results.
+        - duration: Seconds. For host results and task ends.
+        - stats:    Only for 'stats'. Like get_host_stats.
+        """
+        event_type = event.get('event')
+        event_data = event.get('event_data', {})
+        lampsible_event = {
+            'type':     None,
+            'play':     event_data.get('play'),
+            'role':     event_data.get('role'),
+            'task':     event_data.get('task'),
+            'host':     None,
+            'status':   None,
+            'changed':  False,
+            'failed':   False,
+            'msg':      None,
+            'duration': None,
+            'stats':    None,
+        }
+        events = []
+
+        if event_type in [
+            'playbook_on_play_start',
+            'playbook_on_task_start',
+            'playbook_on_stats',
+        ]:
+            if self._current_task:
+                task_end = dict(self._current_task, type='task_end')
+                try:
+                    task_end['duration'] = (
+                        datetime.fromisoformat(event['created'])
+                        - datetime.fromisoformat(task_end.pop('created'))
+                    ).total_seconds()
+                except (KeyError, TypeError, ValueError):
+                    task_end.pop('created', None)
+                events.append(task_end)
+                self._current_task = None
+
+        if event_type == 'playbook_on_play_start':
+            lampsible_event['type'] = 'play_start'
+        elif event_type == 'playbook_on_task_start':
+            lampsible_event['type'] = 'task_start'
+            self._current_task = dict(
+                lampsible_event,
+                created=event.get('created')
+            )
+        elif event_type in [
+            'runner_on_ok',
+            'runner_on_failed',
+            'runner_on_skipped',
+            'runner_on_unreachable',
+        ]:
+            res = event_data.get('res', {})
+            status = event_type.replace('runner_on_', '')
+            if status == 'ok' and res.get('changed'):
+                status = 'changed'
+            elif status == 'failed' and event_data.get('ignore_errors'):
+                status = 'ok'
+            lampsible_event.update({
+                'type':     'host_result',
+                'host':     event_data.get('host'),
+                'status':   status,
+                'changed':  bool(res.get('changed')),
+                'failed':   status in ['failed', 'unreachable'],
+                'duration': event_data.get('duration'),
+            })
+            if lampsible_event['failed']:
+                lampsible_event['msg'] = res.get('msg')
+        elif event_type == 'playbook_on_stats':
+            lampsible_event['type'] = 'stats'
+            lampsible_event['stats'] = self._get_host_stats_from(event_data)
+        else:
+            return events
+
+        events.append(lampsible_event)
+        return events
+
+
+    def _collect_plan_summary(self):
+        self.plan_summary = {
+            host: {
+                'changed_tasks': [],
+                'failed_tasks':  [],
+                'files':         [],
+                'packages':      [],
+            } for host in self.get_all_hosts()
+        }
+        for event in self.runner.events:
+            if event.get('event') not in ['runner_on_ok', 'runner_on_failed']:
+                continue
+            event_data = event['event_data']
+            res = event_data.get('res', {})
+            try:
+                host_summary = self.plan_summary[event_data['host']]
+            except KeyError:
+                continue
+            task = {
+                'role':   event_data.get('role'),
+                'task':   event_data.get('task'),
+                'module': event_data.get('task_action'),
+            }
+
+            if event['event'] == 'runner_on_failed':
+                if not event_data.get('ignore_errors'):
+                    task['msg'] = res.get('msg')
+                    host_summary['failed_tasks'].append(task)
+                continue
+            if not res.get('changed'):
+                continue
+
+            host_summary['changed_tasks'].append(task)
+            for result in res.get('results', [res]):
+                if not result.get('changed'):
+                    continue
+                if task['module'] in [
+                    'template',
+                    'copy',
+                    'lineinfile',
+                    'file',
+                    'ansible.builtin.template',
+                    'ansible.builtin.copy',
+                    'ansible.builtin.lineinfile',
+                    'ansible.builtin.file',
+                ]:
+                    path = result.get('dest') or result.get('path')
+                    if path and path not in host_summary['files']:
+                        host_summary['files'].append(path)
+                elif task['module'] in ['apt', 'ansible.builtin.apt']:
+                    for package in re.findall(
+                        r'^Inst (\S+)',
+                        result.get('stdout', ''),
+                        re.MULTILINE
+                    ):
+                        if package not in host_summary['packages']:
+                            host_summary['packages'].append(package)
+
+
+    def print_plan_summary(self):
+        for host, host_summary in self.plan_summary.items():
+            print('\n{}:'.format(host))
+            for task in host_summary['changed_tasks']:
+                print('  would change: {}{}'.format(
+                    '{} : '.format(task['role']) if task['role'] else '',
+                    task['task']
+                ))
+            for path in host_summary['files']:
+                print('  would write:  {}'.format(path))
+            for package in host_summary['packages']:
+                print('  would install: {}'.format(package))
+            for task in host_summary['failed_tasks']:
+                print('  could not check: {}{} ({})'.format(
+                    '{} : '.format(task['role']) if task['role'] else '',
+                    task['task'],
+                    task['msg']
+                ))
+
+
+    def _collect_capacity_plans(self):
+        """Picks the plans that the capacity role made for each host
+        out of the run's events, see capacity.py.
+        """
+        self.capacity_plans = {}
+        for event in self.runner.events:
+            if event.get('event') != 'runner_on_ok':
+                continue
+            event_data = event['event_data']
+            facts = event_data.get('res', {}).get('ansible_facts', {})
+            if 'lampsible_capacity' in facts:
+                self.capacity_plans[event_data['host']] = \
+                    facts['lampsible_capacity']
+
+
+    def print_capacity_plans(self):
+        if not self.capacity_plans:
+            return
+        print('\nCapacity plan:')
+        for host, plan in self.capacity_plans.items():
+            print_capacity_plan(host, plan)
+
+
+    async def run_async(self, event_callback=None, profile=False):
+        """Like run, but can be awaited, so that other deployments,
+        or anything else, can make progress while this one is running.
+        Ansible Runner does the work in a separate thread, so that's
+        also where event_callback is called.
+        """
+        return await asyncio.to_thread(self.run, event_callback, profile)
+
+
+async def run_many_async(lampsibles,
+        max_concurrent=DEFAULT_MAX_CONCURRENT_DEPLOYMENTS):
+    """Runs several independent Lampsible deployments, at most
+    max_concurrent of them at the same time.
+
+    Returns a list with the result of each deployment, in the same order
+    as the lampsibles argument. The result is either the rc of the run,
+    or the exception raised by it, so that one broken deployment doesn't
+    hide the results of all others.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run_one(lampsible):
+        async with semaphore:
+            return await lampsible.run_async()
+
+    return await asyncio.gather(
+        *[run_one(lampsible) for lampsible in lampsibles],
+        return_exceptions=True
+    )
+
+
+def run_many(lampsibles, max_concurrent=DEFAULT_MAX_CONCURRENT_DEPLOYMENTS):
+    """Blocking version of run_many_async, for callers that
+    don't have an event loop of their own.
+    """
+    return asyncio.run(run_many_async(lampsibles, max_concurrent))
@@ -0,0 +1,193 @@
+import os
+import json
+from datetime import datetime, timezone
+from lampsible.constants import *
+
+
+class Profiler():
+    """Collects wall-clock timings per task, per role and per host from the
+    events of a Lampsible run, see Lampsible._to_lampsible_event.
+    Timings are aggregated while the run is going, so memory doesn't grow
+    with the number of events, only with the number of distinct tasks and hosts.
+
+    Task and role durations are measured from the start of one task to the
+    start of the next, so they include waiting for the slowest host.
+    Host durations are the sum of that host's own task results.
+    """
+
+    def __init__(self, action=None):
+        self.action  = action
+        self.started = None
+        self.ended   = None
+        self.tasks   = {}
+        self.roles   = {}
+        self.changed = {}
+        self.hosts   = {}
+
+
+    def handle_event(self, event):
+        if self.started is None:
+            self.started = datetime.now(timezone.utc)
+
+        if event['type'] == 'task_end' and event['duration'] is not None:
+            task = self._get_task(event)
+            task['duration'] += event['duration']
+            task['count']    += 1
+            role = event['role'] or ''
+            self.roles[role] = self.roles.get(role, 0) + event['duration']
+
+        elif event['type'] == 'host_result' and event['duration'] is not None:
+            task = self._get_task(event)
+            task['hosts'][event['host']] = (
+                task['hosts'].get(event['host'], 0) + event['duration']
+            )
+            self.hosts[event['host']] = (
+                self.hosts.get(event['host'], 0) + event['duration']
+            )
+            if event['changed']:
+                role = event['role'] or ''
+                self.changed[role] = self.changed.get(role, 0) + 1
+
+        elif event['type'] == 'stats':
+            self.ended = datetime.now(timezone.utc)
+
+
+    def _get_task(self, event):
+        key = get_task_key(event['role'], event['task'])
+        if key not in self.tasks:
+            self.tasks[key] = {
+                'role':     event['role'] or '',
+                'task':     event['task'],
+                'duration': 0,
+                'count':    0,
+                'hosts':    {},
+            }
+        return self.tasks[key]
+
+
+    def get_report(self):
+        """Returns the report as a dict, which can be dumped as JSON.
+        Tasks and roles are keyed on their names, so that reports of two
+        runs can be compared, see compare_profile_reports.
+        """
+        ended = self.ended or datetime.now(timezone.utc)
+        return {
+            'version': PROFILE_REPORT_VERSION,
+            'action':  self.action,
+            'started': self.started.isoformat() if self.started else None,
+            'total_duration': round(
+                (ended - self.started).total_seconds(), 3
+            ) if self.started else 0,
+            'tasks': {
+                key: dict(
+                    task,
+                    duration=round(task['duration'], 3),
+                    hosts={
+                        host: round(duration, 3)
+                        for host, duration in task['hosts'].items()
+                    }
+                ) for key, task in self.tasks.items()
+            },
+            'roles': {
+                role: round(duration, 3)
+                for role, duration in self.roles.items()
+            },
+            # Number of changed host results per role.
+            'changed': dict(self.changed),
+            'hosts': {
+                host: round(duration, 3)
+                for host, duration in self.hosts.items()
+            },
+        }
+
+
+    def write_report(self, profile_dir):
+        """Writes the report into profile_dir and returns its path."""
+        os.makedirs(profile_dir, exist_ok=True)
+        report = self.get_report()
+        path = os.path.join(profile_dir, '{}-{}.json'.format(
+            (self.started or datetime.now(timezone.utc)).strftime(
+                '%Y%m%dT%H%M%S%fZ'),
+            self.action
+        ))
+        with open(path, 'w') as stream:
+            json.dump(report, stream, indent=4, sort_keys=True)
+        return path
+
+
+def get_task_key(role, task):
+    return '{} : {}'.format(role, task) if role else task
+
+
+def load_profile_report(path):
+    with open(path, 'r') as stream:
+        return json.load(stream)
+
+
+def print_profile_report(report, top_n=DEFAULT_PROFILE_TOP_N):
+    print('\nTotal: {:.1f}s'.format(report['total_duration']))
+
+    print('\nSlowest tasks:')
+    tasks = sorted(
+        report['tasks'].items(),
+        key=lambda item: item[1]['duration'],
+        reverse=True
+    )
+    for key, task in tasks[:top_n]:
+        print('  {:>8.1f}s  {}'.format(task['duration'], key))
+
+    print('\nRoles:')
+    for role, duration in sorted(
+        report['roles'].items(),
+        key=lambda item: item[1],
+        reverse=True
+    ):
+        print('  {:>8.1f}s  {}'.format(duration, role or '(no role)'))
+
+    print('\nHosts:')
+    for host, duration in sorted(report['hosts'].items()):
+        print('  {:>8.1f}s  {}'.format(duration, host))
+
+
+def compare_profile_reports(old_report, new_report):
+    """Returns a dict with the difference in seconds between two reports,
+    for the total duration and for each role and task that appears
+    in either of them. Positive values mean that the new run was slower.
+    """
+    def diff(old, new):
+        return {
+            key: round(new.get(key, 0) - old.get(key, 0), 3)
+            for key in sorted(set(old) | set(new))
+        }
+
+    return {
+        'total_duration': round(
+            new_report['total_duration'] - old_report['total_duration'], 3
+        ),
+        'roles': diff(old_report['roles'], new_report['roles']),
+        'tasks': diff(
+            {key: task['duration']
+                for key, task in old_report['tasks'].items()},
+            {key: task['duration']
+                for key, task in new_report['tasks'].items()}
+        ),
+    }
+
+
+def print_profile_comparison(comparison, top_n=DEFAULT_PROFILE_TOP_N):
+    print('\nCompared to the previous report: {:+.1f}s'.format(
+        comparison['total_duration']))
+    print('\nBiggest changes per role:')
+    for role, delta in sorted(
+        comparison['roles'].items(),
+        key=lambda item: abs(item[1]),
+        reverse=True
+    )[:top_n]:
+        print('  {:>+8.1f}s  {}'.format(delta, role or '(no role)'))
+    print('\nBiggest changes per task:')
+    for key, delta in sorted(
+        comparison['tasks'].items(),
+        key=lambda item: abs(item[1]),
+        reverse=True
+    )[:top_n]:
+        print('  {:>+8.1f}s  {}'.format(delta, key))
@@ -0,0 +1,38 @@
+"""Exposes lampsible.capacity to the playbooks, see the capacity role.
+Filters run on the controller, so this is Lampsible's own code, along
+with the facts that were gathered from each host.
+"""
+
+import os
+import sys
+
+try:
+    from lampsible.capacity import get_capacity_plan
+except ImportError:
+    # Ansible might not run in the Python environment that Lampsible
+    # is installed in. This is lampsible/project/filter_plugins.
+    sys.path.append(os.path.abspath(os.path.join(
+        os.path.dirname(__file__), '..', '..', '..')))
+    from lampsible.capacity import get_capacity_plan
+
+
+def lampsible_capacity_plan(facts, action, web=True, database=False,
+        php=True, php_fpm=True, object_cache=False):
+    return get_capacity_plan(
+        memtotal_mb=int(facts['memtotal_mb']),
+        vcpus=int(facts.get('processor_vcpus') or 1),
+        action=action,
+        web=bool(web),
+        database=bool(database),
+        php=bool(php),
+        php_fpm=bool(php_fpm),
+        object_cache=bool(object_cache),
+    )
+
+
+class FilterModule():
+
+    def filters(self):
+        return {
+            'lampsible_capacity_plan': lampsible_capacity_plan,
+        }
@@ -0,0 +1,141 @@
+"""Uploads an app build archive, but only the files that differ on the host.
+
+The archive is read on the controller, to get the size and SHA-256 of each
+file in it. The lampsible_app_delta module compares those with the files
+on the host, and only the files that are missing or differ are packed into
+a smaller archive, which is uploaded and extracted. If nothing is on the
+host yet, the original archive is uploaded as is.
+
+Options: src, dest, owner, group, app_dir, basis, cache_file.
+See lampsible_app_delta for the last three.
+"""
+
+import os
+import tarfile
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+from ansible.errors import AnsibleActionFail
+from ansible.plugins.action import ActionBase
+
+
+def get_member_path(member):
+    path = os.path.normpath(member.name)
+    if os.path.isabs(path) or path == '..' or path.startswith('../'):
+        raise AnsibleActionFail(
+            'Refusing archive member outside of dest: {}'.format(member.name))
+    return path
+
+
+def get_manifest(src):
+    manifest = {}
+    with tarfile.open(src, 'r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            checksum = sha256()
+            stream = archive.extractfile(member)
+            for chunk in iter(lambda: stream.read(1 << 20), b''):
+                checksum.update(chunk)
+            manifest[get_member_path(member)] = [
+                member.size,
+                checksum.hexdigest()
+            ]
+    return manifest
+
+
+def write_delta(src, delta_path, changed_paths):
+    """Copies the changed files, and all directories and links,
+    which are cheap, from src into a new archive at delta_path.
+    """
+    changed_paths = set(changed_paths)
+    with tarfile.open(src, 'r|*') as archive, \
+            tarfile.open(delta_path, 'w:gz') as delta:
+        for member in archive:
+            if member.isfile():
+                if get_member_path(member) in changed_paths:
+                    delta.addfile(member, archive.extractfile(member))
+            else:
+                delta.addfile(member)
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        src  = self._task.args.get('src')
+        dest = self._task.args.get('dest')
+        try:
+            if not src or not dest:
+                raise AnsibleActionFail('src and dest are required')
+            src = os.path.expanduser(src)
+
+            manifest = get_manifest(src)
+            delta_result = self._execute_module(
+                module_name='lampsible_app_delta',
+                module_args={
+                    'dest':       dest,
+                    'manifest':   manifest,
+                    'app_dir':    self._task.args.get('app_dir'),
+                    'basis':      self._task.args.get('basis'),
+                    'cache_file': self._task.args.get('cache_file'),
+                },
+                task_vars=task_vars
+            )
+            if delta_result.get('failed'):
+                return delta_result
+
+            changed_paths = delta_result['changed_paths']
+            result.update({
+                'changed':           delta_result['changed'],
+                'files':             len(manifest),
+                'transferred_files': len(changed_paths),
+                'transferred_bytes': 0,
+            })
+            if not changed_paths:
+                return result
+            result['changed'] = True
+            if self._task.check_mode:
+                return result
+
+            with TemporaryDirectory() as tmp_dir:
+                if len(changed_paths) == len(manifest):
+                    upload_path = src
+                else:
+                    upload_path = os.path.join(tmp_dir, 'delta.tar.gz')
+                    write_delta(src, upload_path, changed_paths)
+                result['transferred_bytes'] = os.path.getsize(upload_path)
+
+                tmp_src = self._connection._shell.join_path(
+                    self._connection._shell.tmpdir, 'source')
+                self._transfer_file(upload_path, tmp_src)
+            self._fixup_perms2((self._connection._shell.tmpdir, tmp_src))
+
+            unarchive_args = {
+                'src':        tmp_src,
+                'dest':       dest,
+                'remote_src': True,
+            }
+            for key in ['owner', 'group']:
+                if self._task.args.get(key):
+                    unarchive_args[key] = self._task.args[key]
+            unarchive_result = self._execute_module(
+                module_name='ansible.legacy.unarchive',
+                module_args=unarchive_args,
+                task_vars=task_vars
+            )
+            if unarchive_result.get('failed'):
+                return unarchive_result
+            return result
+
+        except (AnsibleActionFail, OSError, tarfile.TarError) as e:
+            result.update({'failed': True, 'msg': str(e)})
+            return result
+        finally:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+DOCUMENTATION = r'''
+---
+module: lampsible_app_delta
+short_description: Finds the files of an app build that differ on the host.
+description:
+  - Compares a manifest of the files in an app build archive with the
+    files under I(dest), and returns those that are missing or differ.
+  - Used by the lampsible_app_upload action, which then only uploads those.
+  - Checksums are cached in I(cache_file), keyed on size and inode change
+    time, so unchanged files aren't read again on the next deploy.
+options:
+  dest:
+    description: Directory that the archive is extracted into.
+    type: path
+    required: true
+  manifest:
+    description: Relative path of each file, mapped to its size and SHA-256.
+    type: dict
+    required: true
+  app_dir:
+    description: The app's directory, inside of I(dest).
+    type: path
+  basis:
+    description:
+      - A previous release of the app on the host. If I(app_dir) doesn't
+        exist yet, it's copied from here first, so that only the files that
+        differ from that release need to be uploaded.
+    type: path
+  cache_file:
+    description: Where to cache checksums between deploys.
+    type: path
+'''
+
+import os
+import json
+import shutil
+from hashlib import sha256
+from ansible.module_utils.basic import AnsibleModule
+
+
+def get_checksum(path):
+    checksum = sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            dest=dict(type='path', required=True),
+            manifest=dict(type='dict', required=True),
+            app_dir=dict(type='path'),
+            basis=dict(type='path'),
+            cache_file=dict(type='path'),
+        ),
+        supports_check_mode=True,
+    )
+    dest       = module.params['dest']
+    app_dir    = module.params['app_dir']
+    basis      = module.params['basis']
+    cache_file = module.params['cache_file']
+    changed    = False
+
+    if app_dir and basis and not os.path.exists(app_dir) \
+            and os.path.isdir(basis):
+        if not module.check_mode:
+            shutil.copytree(basis, app_dir, symlinks=True)
+        changed = True
+
+    cache = {}
+    if cache_file:
+        try:
+            with open(cache_file, 'r') as stream:
+                cache = json.load(stream)
+        except (OSError, ValueError):
+            pass
+
+    new_cache     = {}
+    changed_paths = []
+    for rel_path, (size, checksum) in module.params['manifest'].items():
+        path = os.path.join(dest, rel_path)
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            changed_paths.append(rel_path)
+            continue
+        if not os.path.isfile(path) or os.path.islink(path) \
+                or stat.st_size != size:
+            changed_paths.append(rel_path)
+            continue
+
+        # Not the modification time, because tar restores that from the
+        # archive, but the inode change time, which nothing can set.
+        key = [stat.st_size, stat.st_ctime_ns]
+        if cache.get(rel_path, [None])[:2] == key:
+            remote_checksum = cache[rel_path][2]
+        else:
+            remote_checksum = get_checksum(path)
+        new_cache[rel_path] = key + [remote_checksum]
+        if remote_checksum != checksum:
+            changed_paths.append(rel_path)
+
+    if cache_file and not module.check_mode and new_cache != cache:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        with open(cache_file, 'w') as stream:
+            json.dump(new_cache, stream)
+
+    module.exit_json(
+        changed=changed,
+        changed_paths=sorted(changed_paths),
+        checked=len(module.params['manifest']),
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import os
+import json
+from re import match
+from time import time
+from lampsible.constants import *
+
+
+class VersionIndex():
+    """Knows which WordPress and Joomla versions exist, so that
+    ArgValidator doesn't have to ask the internet every time.
+
+    Versions that are known to exist are kept in a JSON file in the user's
+    cache directory. They are consulted first, along with the versions that
+    ship with Lampsible, and they never expire, because releases don't
+    disappear. Versions that turned out not to exist, and the full WordPress
+    release list, are refreshed at most once per ttl seconds.
+    Network requests are bounded by timeout seconds. If the network can't
+    be reached, and the version isn't known yet, it's accepted with a warning.
+    """
+
+    def __init__(self, path=DEFAULT_VERSION_INDEX_FILE,
+            ttl=DEFAULT_VERSION_INDEX_TTL,
+            timeout=DEFAULT_VERSION_INDEX_TIMEOUT):
+        self.path    = path
+        self.ttl     = ttl
+        self.timeout = timeout
+        self.index   = self._load()
+
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as stream:
+                index = json.load(stream)
+            assert isinstance(index, dict)
+        except (OSError, ValueError, AssertionError):
+            index = {}
+        for system in ['wordpress', 'joomla']:
+            index.setdefault(system, {})
+            index[system].setdefault('fetched', 0)
+            index[system].setdefault('versions', [])
+            index[system].setdefault('invalid', {})
+        return index
+
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as stream:
+                json.dump(self.index, stream, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('Warning! Could not save version index: {}'.format(e))
+
+
+    def _is_fresh(self, timestamp):
+        return time() - timestamp < self.ttl
+
+
+    def _remember(self, system, version, exists):
+        if exists:
+            if version not in self.index[system]['versions']:
+                self.index[system]['versions'].append(version)
+            self.index[system]['invalid'].pop(version, None)
+        else:
+            self.index[system]['invalid'][version] = time()
+        self._save()
+
+
+    def is_valid_wordpress_version(self, version):
+        system = self.index['wordpress']
+        if version in RECENT_WORDPRESS_VERSIONS \
+                or version in system['versions']:
+            return True
+        if version in system['invalid'] \
+                and self._is_fresh(system['invalid'][version]):
+            return False
+        if self._is_fresh(system['fetched']):
+            # The release list is complete, and fresh enough.
+            return False
+
+        # Imported here, because it's slow to import, and rarely needed.
+        import requests
+        try:
+            response = requests.get(WORDPRESS_VERSIONS_URL,
+                timeout=self.timeout)
+            response.raise_for_status()
+            versions = list(response.json().keys())
+            system['versions'] = sorted(set(system['versions'] + versions))
+            system['fetched']  = time()
+            self._remember('wordpress', version, version in versions)
+            return version in versions
+        except requests.ConnectionError:
+            # Also covers timeouts when connecting. Don't try again below,
+            # it would only fail the same way.
+            return self._accept_unverified('WordPress', version)
+        except (requests.RequestException, ValueError, AttributeError):
+            pass
+
+        return self._probe('wordpress', version,
+            WORDPRESS_DOWNLOAD_URL.format(version))
+
+
+    def is_valid_joomla_version(self, version):
+        if not match(r'^[0-9]+\.[0-9]+\.[0-9]+$', version):
+            return False
+        system = self.index['joomla']
+        if version == DEFAULT_JOOMLA_VERSION or version in system['versions']:
+            return True
+        if version in system['invalid'] \
+                and self._is_fresh(system['invalid'][version]):
+            return False
+        return self._probe('joomla', version, JOOMLA_DOWNLOAD_URL.format(
+            major=version.split('.')[0],
+            version=version.replace('.', '-')
+        ))
+
+
+    def _probe(self, system, version, url):
+        import requests
+        try:
+            response = requests.head(url, timeout=self.timeout,
+                allow_redirects=True)
+        except requests.RequestException:
+            return self._accept_unverified(system.capitalize(), version)
+        # Don't remember server errors, they say nothing about the version.
+        if response.status_code >= 500:
+            return self._accept_unverified(system.capitalize(), version)
+        exists = response.status_code == 200
+        self._remember(system, version, exists)
+        return exists
+
+
+    def _accept_unverified(self, system_name, version):
+        print('Warning! Could not verify that {} version {} exists.'.format(
+            system_name, version))
+        return True
@@ -0,0 +1,315 @@
+"""Offline benchmarks for Lampsible itself, as opposed to the hosts it
+deploys to. Runs on a plain Linux box without network access or
+a remote server, and prints the results as JSON.
+
+Micro benchmarks time the controller side hot paths, like building
+the Lampsible object and writing the Ansible Runner environment.
+
+Macro benchmarks run the playbook of each action against localhost, in
+check mode, with a local connection and without become. Modules that
+would install packages, touch services, databases or the network are
+replaced by stand-in action plugins, which report a change and do nothing,
+so what's left is mostly Lampsible's and Ansible's own overhead.
+
+Usage:
+
+    python test/benchmark_lampsible.py [--repeat N] [--actions apache,...]
+        [--skip-macro] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tarfile
+import platform
+import subprocess
+from io import StringIO
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from importlib.metadata import version
+from shutil import rmtree
+from statistics import mean, median
+from tempfile import mkdtemp
+from time import perf_counter
+from lampsible import __version__
+from lampsible.lampsible import Lampsible
+from lampsible.arg_validator import ArgValidator
+from lampsible.cli import get_arg_parser
+from lampsible.constants import *
+
+
+MACRO_ACTIONS = [
+    'apache',
+    'mysql',
+    'php',
+    'lamp-stack',
+    'wordpress',
+    'joomla',
+    'drupal',
+    'laravel',
+]
+
+# Modules that must not run on the benchmarking machine.
+STUBBED_MODULES = [
+    'apt',
+    'pip',
+    'get_url',
+    'unarchive',
+    'service',
+    'command',
+    'openssl_privatekey',
+    'openssl_csr',
+    'openssl_certificate',
+]
+STUBBED_COLLECTION_MODULES = {
+    ('community', 'general'): ['composer', 'snap'],
+    ('community', 'mysql'):   ['mysql_user', 'mysql_db'],
+}
+STUB_ACTION_PLUGIN = '''\
+from ansible.plugins.action import ActionBase
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+    _supports_check_mode = True
+
+    def run(self, tmp=None, task_vars=None):
+        result = super().run(tmp, task_vars)
+        result.update({
+            'changed': True,
+            'rc': 0,
+            'stdout': '',
+            'stdout_lines': [],
+            'stderr': '',
+            'stderr_lines': [],
+        })
+        return result
+'''
+
+
+class BenchmarkLampsible(Lampsible):
+    """Lampsible, with the stand-in modules of stub_dir, and
+    without become, because nothing is changed anyway.
+    """
+
+    def __init__(self, stub_dir, *args, **kwargs):
+        self.stub_dir = stub_dir
+        super().__init__(*args, **kwargs)
+        self.runner_config.quiet = True
+
+
+    def get_ansible_envvars(self):
+        envvars = super().get_ansible_envvars()
+        envvars['ANSIBLE_ACTION_PLUGINS'] = os.path.join(
+            self.stub_dir, 'action_plugins')
+        envvars['ANSIBLE_COLLECTIONS_PATH'] = os.path.join(
+            self.stub_dir, 'collections')
+        return envvars
+
+
+    def _update_env(self, check=False):
+        super()._update_env(check=check)
+        self.private_data_helper.set_extravar('ansible_become', False)
+        self.private_data_helper.write_env()
+
+
+    def _ensure_galaxy_dependencies(self):
+        # The stand-ins in stub_dir replace the collections.
+        return 0
+
+
+def write_stubs(stub_dir):
+    action_dir = os.path.join(stub_dir, 'action_plugins')
+    os.makedirs(action_dir)
+    for module in STUBBED_MODULES:
+        with open(os.path.join(action_dir, module + '.py'), 'w') as stream:
+            stream.write(STUB_ACTION_PLUGIN)
+
+    for (namespace, name), modules in STUBBED_COLLECTION_MODULES.items():
+        collection_dir = os.path.join(stub_dir, 'collections',
+            'ansible_collections', namespace, name)
+        os.makedirs(os.path.join(collection_dir, 'plugins', 'action'))
+        with open(os.path.join(collection_dir, 'MANIFEST.json'), 'w') \
+                as stream:
+            json.dump({'collection_info': {
+                'namespace': namespace,
+                'name':      name,
+                'version':   '0.0.0',
+            }}, stream)
+        for module in modules:
+            with open(os.path.join(collection_dir, 'plugins', 'action',
+                    module + '.py'), 'w') as stream:
+                stream.write(STUB_ACTION_PLUGIN)
+
+
+def time_it(func, repeat):
+    """Calls func repeat times and returns timing statistics in seconds.
+    If func returns a callable, that's called after each measurement,
+    to clean up.
+    """
+    durations = []
+    for _ in range(repeat):
+        start   = perf_counter()
+        cleanup = func()
+        durations.append(perf_counter() - start)
+        if callable(cleanup):
+            cleanup()
+    return {
+        'repeat': repeat,
+        'min':    min(durations),
+        'median': median(durations),
+        'mean':   mean(durations),
+    }
+
+
+def get_lampsible_kwargs(action, work_dir):
+    kwargs = {
+        'web_user':          'root',
+        'web_host':          'localhost',
+        'action':            action,
+        'private_data_dir':  mkdtemp(prefix='run-', dir=work_dir),
+        'fact_cache_dir':    os.path.join(work_dir, 'facts'),
+        'profile_dir':       os.path.join(work_dir, 'profiles'),
+        'history_file':      None,
+        'artifact_cache_dir': None,
+        'ssl_certbot':       False,
+        'database_username': DEFAULT_DATABASE_USERNAME,
+        'database_password': 'password',
+        'database_name':     'benchmark',
+        'admin_password':    'passwordpassword',
+        'php_version':       DEFAULT_PHP_VERSION,
+    }
+    if action == 'laravel':
+        app_build_path = os.path.join(work_dir, 'laravel-app.tar.gz')
+        if not os.path.exists(app_build_path):
+            with tarfile.open(app_build_path, 'w:gz') as archive:
+                archive.add(__file__, 'laravel-app/benchmark.php')
+        kwargs['app_name']       = 'laravel-app'
+        kwargs['app_build_path'] = app_build_path
+    return kwargs
+
+
+def run_micro_benchmarks(work_dir, repeat):
+    results = {}
+
+    def init():
+        lampsible = Lampsible(**get_lampsible_kwargs('wordpress', work_dir))
+        return lambda: rmtree(lampsible.private_data_dir)
+
+    results['Lampsible.__init__'] = time_it(init, repeat)
+
+    lampsible = Lampsible(**get_lampsible_kwargs('wordpress', work_dir))
+    results['Lampsible.set_action'] = time_it(
+        lambda: lampsible.set_action('wordpress'), repeat)
+    results['Lampsible._set_apache_vars'] = time_it(
+        lampsible._set_apache_vars, repeat)
+    results['Lampsible._update_env'] = time_it(
+        lampsible._update_env, repeat)
+    results['PrivateData.write_env'] = time_it(
+        lampsible.private_data_helper.write_env, repeat)
+    rmtree(lampsible.private_data_dir)
+
+    argv = [
+        'root@localhost', 'wordpress',
+        '--insecure-no-ssl',
+        '--insecure-cli-password',
+        '--database-username', DEFAULT_DATABASE_USERNAME,
+        '--database-password', 'password',
+        '--database-name', 'benchmark',
+        '--database-table-prefix', 'benchmark_',
+        '--site-title', DEFAULT_SITE_TITLE,
+        '--admin-username', DEFAULT_ADMIN_USERNAME,
+        '--admin-email', DEFAULT_ADMIN_EMAIL,
+        '--admin-password', 'passwordpassword',
+        '--wordpress-version', RECENT_WORDPRESS_VERSIONS[0],
+    ]
+
+    def validate():
+        args = get_arg_parser().parse_args(argv)
+        with redirect_stdout(StringIO()):
+            assert ArgValidator(args).validate_args() == 0
+
+    results['ArgValidator.validate_args'] = time_it(validate, repeat)
+
+    results['CLI startup'] = time_it(
+        lambda: subprocess.run(
+            [sys.executable, '-m', 'lampsible.cli', '--version'],
+            check=True,
+            stdout=subprocess.DEVNULL
+        ),
+        repeat
+    )
+    return results
+
+
+def run_macro_benchmarks(work_dir, actions):
+    stub_dir = os.path.join(work_dir, 'stubs')
+    write_stubs(stub_dir)
+
+    results = {}
+    for action in actions:
+        lampsible = BenchmarkLampsible(
+            stub_dir,
+            **get_lampsible_kwargs(action, work_dir)
+        )
+        start = perf_counter()
+        with redirect_stdout(StringIO()):
+            lampsible.plan()
+        results[action] = {
+            'duration': perf_counter() - start,
+            'rc':       lampsible.rc,
+            'tasks':    sum(
+                stats['ok'] + stats['changed'] + stats['skipped']
+                    + stats['failures']
+                for stats in lampsible.get_host_stats().values()
+            ),
+            'failed_tasks': [
+                '{} : {}'.format(task['role'], task['task'])
+                for summary in lampsible.plan_summary.values()
+                for task in summary['failed_tasks']
+            ],
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks for Lampsible.')
+    parser.add_argument('--repeat', type=int, default=20,
+        help='how often each micro benchmark is repeated')
+    parser.add_argument('--actions', default=','.join(MACRO_ACTIONS),
+        help='comma separated list of actions for the macro benchmarks')
+    parser.add_argument('--skip-macro', action='store_true')
+    parser.add_argument('--output', help='write the JSON here, not to stdout')
+    args = parser.parse_args()
+
+    work_dir = mkdtemp(prefix='lampsible-benchmark-')
+    try:
+        results = {
+            'created':      datetime.now(timezone.utc).isoformat(),
+            'lampsible':    __version__,
+            'ansible_core': version('ansible-core'),
+            'python':       platform.python_version(),
+            'platform':     platform.platform(),
+            'micro':        run_micro_benchmarks(work_dir, args.repeat),
+            'macro':        {} if args.skip_macro else run_macro_benchmarks(
+                work_dir,
+                args.actions.split(',')
+            ),
+        }
+    finally:
+        rmtree(work_dir)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
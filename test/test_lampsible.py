@@ -1,8 +1,23 @@
+import gc
 import os
+import re
+import sys
+import json
 import unittest
+import subprocess
+from hashlib import sha256
+from time import time, sleep
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 from getpass import getpass, getuser
 from lampsible import __version__
 from lampsible.lampsible import Lampsible
+from lampsible.history import RunHistory
+from lampsible.version_index import VersionIndex
+from lampsible.capacity import get_capacity_plan
+from lampsible.artifact_cache import (
+    ArtifactCache, get_wordpress_artifact_source
+)
 from lampsible.constants import *
 
 class TestLampsible(unittest.TestCase):
@@ -43,12 +58,79 @@ class TestLampsible(unittest.TestCase):
         self.assertIn(__version__, self.lampsible.banner)
 
 
+    def test_no_shared_state(self):
+        other_lampsible = Lampsible(
+            web_user=self.lampsible.web_user,
+            web_host=self.lampsible.web_host,
+            action='drupal',
+        )
+        self.assertNotEqual(
+            self.lampsible.private_data_dir,
+            other_lampsible.private_data_dir
+        )
+        self.assertNotIn('drush/drush', self.lampsible.composer_packages)
+        self.assertNotIn('php-gd', self.lampsible.php_extensions)
+        other_lampsible.private_data_helper.cleanup_dir()
+
+
+    def test_dump_ansible_facts(self):
+        self.lampsible.set_action('dump-ansible-facts')
+        self.assertEqual(self.lampsible.dump_ansible_facts(), 0)
+
+
     def test_apache(self):
         self.lampsible.set_action('apache')
         self.lampsible.ssl_certbot = False
         self._do_test_run()
 
 
+    def test_event_callback(self):
+        self.lampsible.set_action('apache')
+        self.lampsible.ssl_certbot = False
+        events = []
+        self.assertEqual(self.lampsible.run(event_callback=events.append), 0)
+        self.assertEqual(events[0]['type'], 'play_start')
+        self.assertEqual(events[-1]['type'], 'stats')
+        self.assertTrue(any(
+            event['type'] == 'host_result' and event['duration'] is not None
+            for event in events
+        ))
+        self.assertFalse(any(event['failed'] for event in events))
+
+
+    def test_stream(self):
+        self.lampsible.set_action('apache')
+        self.lampsible.ssl_certbot = False
+        types = [event['type'] for event in self.lampsible.stream()]
+        self.assertEqual(types.count('task_start'), types.count('task_end'))
+        self.assertEqual(self.lampsible.rc, 0)
+
+
+    def test_profile(self):
+        self.lampsible.set_action('apache')
+        self.lampsible.ssl_certbot = False
+        self.assertEqual(self.lampsible.run(profile=True), 0)
+        self.assertTrue(os.path.isfile(self.lampsible.profile_report_path))
+        self.assertIn('apache2', self.lampsible.profile_report['roles'])
+        self.assertGreater(self.lampsible.profile_report['total_duration'], 0)
+
+
+    def test_history(self):
+        self.lampsible.set_action('apache')
+        self.lampsible.ssl_certbot = False
+        self.lampsible.history_file = os.path.join(
+            'test',
+            'tmp-history.sqlite3',
+        )
+        self.assertEqual(self.lampsible.run(), 0)
+        history = RunHistory(self.lampsible.history_file)
+        run = history.get_runs(limit=1)[0]
+        self.assertEqual(run['id'], self.lampsible.history_run_id)
+        self.assertEqual(run['rc'], 0)
+        self.assertIn('apache2', run['roles'])
+        self.assertEqual(history.find_regressions(run, threshold=100), [])
+
+
     def test_ssl_selfsigned(self):
         self.lampsible.set_action('apache')
         self.lampsible.ssl_selfsigned = True
@@ -143,6 +225,34 @@ class TestLampsible(unittest.TestCase):
         self._do_test_run()
 
 
+    def test_fleet(self):
+        try:
+            tmp_fleet = [
+                user_host.split('@')
+                for user_host in os.environ['LAMPSIBLE_FLEET'].split(',')
+            ]
+        except KeyError:
+            self.skipTest('Got no LAMPSIBLE_FLEET')
+        self.lampsible = Lampsible(
+            web_user=tmp_fleet[0][0],
+            web_host=[user_host[1] for user_host in tmp_fleet],
+            action='apache',
+            private_data_dir=os.path.join(
+                'test',
+                'tmp-private-data',
+            ),
+            ssl_certbot=False,
+            serial='50%',
+            ansible_galaxy_ok=True,
+        )
+        self._do_test_run()
+        self.assertEqual(
+            sorted(self.lampsible.get_host_stats().keys()),
+            sorted([user_host[1] for user_host in tmp_fleet])
+        )
+        self.assertEqual(self.lampsible.get_failed_hosts(), [])
+
+
     def _do_test_run(self):
         result = self.lampsible.run()
         self.assertEqual(result, 0)
@@ -151,3 +261,377 @@ class TestLampsible(unittest.TestCase):
     # TODO?
     # def test_validator(self):
     #     self.assertEqual(1, 1)
+
+
+class TestCliStartup(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        # Doesn't need a remote server, '--version' exits before
+        # anything is deployed.
+        result = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import sys\n'
+                'sys.argv = ["lampsible", "--version"]\n'
+                'from lampsible.cli import main\n'
+                'try:\n'
+                '    main()\n'
+                'except SystemExit:\n'
+                '    pass\n'
+                'print(",".join(sys.modules))\n'
+            ],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        modules = result.stdout.splitlines()[-1].split(',')
+        for module in [
+            'ansible_runner',
+            'ansible_directory_helper',
+            'requests',
+            'yaml',
+            'fqdn',
+            'lampsible.lampsible',
+        ]:
+            self.assertNotIn(module, modules)
+
+
+class TestVersionIndex(unittest.TestCase):
+
+    def test_cached_versions(self):
+        # Doesn't touch the network, everything is answered from the cache.
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'versions.json')
+            with open(path, 'w') as stream:
+                json.dump({
+                    'wordpress': {
+                        'fetched':  time(),
+                        'versions': ['6.2.1'],
+                        'invalid':  {},
+                    },
+                    'joomla': {
+                        'fetched':  0,
+                        'versions': ['5.1.4'],
+                        'invalid':  {'4.0.0': time()},
+                    },
+                }, stream)
+            version_index = VersionIndex(path=path)
+            self.assertTrue(version_index.is_valid_wordpress_version('latest'))
+            self.assertTrue(version_index.is_valid_wordpress_version('6.2.1'))
+            self.assertFalse(version_index.is_valid_wordpress_version('1.2.3'))
+            self.assertTrue(version_index.is_valid_joomla_version('5.1.4'))
+            self.assertFalse(version_index.is_valid_joomla_version('4.0.0'))
+            self.assertFalse(version_index.is_valid_joomla_version('five'))
+
+
+class TestCapacityPlan(unittest.TestCase):
+
+    def test_no_oversubscription(self):
+        for memtotal_mb in [512, 1024, 2048, 8192, 65536]:
+            plan = get_capacity_plan(memtotal_mb, 2, 'wordpress',
+                database=True)
+            php_mb = plan['php']['max_children'] * DEFAULT_PHP_FPM_PROCESS_MB
+            mysql_mb = int(plan['mysql']['innodb_buffer_pool_size'][:-1])
+            # Below 1 GB, the minimums take more than there is.
+            if memtotal_mb >= 1024:
+                self.assertLessEqual(
+                    plan['reserved_mb'] + CAPACITY_APACHE_MB
+                        + CAPACITY_OPCACHE_MB + php_mb + mysql_mb,
+                    memtotal_mb
+                )
+            self.assertGreaterEqual(plan['mysql']['max_connections'],
+                plan['php']['max_children'])
+
+    def test_separate_database_host(self):
+        plan = get_capacity_plan(4096, 2, 'mysql', web=False, database=True)
+        self.assertNotIn('apache', plan)
+        self.assertNotIn('php', plan)
+        self.assertIn('mysql', plan)
+
+    def test_mod_php(self):
+        plan = get_capacity_plan(2048, 2, 'lamp-stack', php_fpm=False)
+        self.assertEqual(plan['apache']['mpm'], 'prefork')
+        self.assertEqual(plan['apache']['max_request_workers'],
+            plan['php']['max_children'])
+
+    def test_object_cache(self):
+        without = get_capacity_plan(2048, 2, 'wordpress')
+        plan = get_capacity_plan(2048, 2, 'wordpress', object_cache=True)
+        self.assertEqual(plan['object_cache']['memory_mb'],
+            CAPACITY_OBJECT_CACHE_MB)
+        self.assertLess(plan['php']['max_children'],
+            without['php']['max_children'])
+
+    def get_tiers(self, action):
+        with TemporaryDirectory() as tmp_dir:
+            lampsible = Lampsible(
+                web_user='root',
+                web_host='localhost',
+                action=action,
+                private_data_dir=tmp_dir,
+                history_file=None,
+            )
+            return lampsible.get_capacity_tiers()['localhost']
+
+    def test_mysql_on_single_host(self):
+        tiers = self.get_tiers('mysql')
+        self.assertEqual(tiers,
+            {'web': False, 'php': False, 'database': True})
+        plan = get_capacity_plan(4096, 2, 'mysql', **tiers)
+        self.assertNotIn('apache', plan)
+        self.assertNotIn('php', plan)
+        # MySQL doesn't share the host with Apache and PHP.
+        shared = get_capacity_plan(4096, 2, 'mysql', web=True, database=True)
+        self.assertGreater(
+            int(plan['mysql']['innodb_buffer_pool_size'][:-1]),
+            int(shared['mysql']['innodb_buffer_pool_size'][:-1])
+        )
+
+    def test_apache_on_single_host(self):
+        tiers = self.get_tiers('apache')
+        self.assertEqual(tiers,
+            {'web': True, 'php': False, 'database': False})
+        plan = get_capacity_plan(4096, 2, 'apache', **tiers)
+        self.assertNotIn('mysql', plan)
+        self.assertIn('apache', plan)
+
+    def test_apache_without_php(self):
+        # Even though there's no PHP-FPM, there's no mod_php either.
+        plan = get_capacity_plan(4096, 2, 'apache', php=False, php_fpm=False)
+        self.assertNotIn('php', plan)
+        self.assertEqual(plan['apache']['mpm'], 'event')
+        self.assertEqual(plan['apache']['server_limit'],
+            CAPACITY_MAX_SERVER_LIMIT)
+        small_plan = get_capacity_plan(1024, 1, 'apache', php=False,
+            php_fpm=False)
+        self.assertLessEqual(
+            small_plan['apache']['server_limit'] * CAPACITY_APACHE_PROCESS_MB,
+            1024 - small_plan['reserved_mb']
+        )
+
+
+class TestPageCache(unittest.TestCase):
+
+    def test_bypass(self):
+        with TemporaryDirectory() as tmp_dir:
+            lampsible = Lampsible(
+                web_user='root',
+                web_host='localhost',
+                action='drupal',
+                private_data_dir=tmp_dir,
+                history_file=None,
+                page_cache=True,
+            )
+            lampsible._set_apache_vars()
+            page_cache = lampsible.apache_vhosts[0]['page_cache']
+            self.assertIn('/user', page_cache['bypass_paths'])
+            self.assertTrue(re.search(page_cache['bypass_cookies'],
+                'has_js=1; SSESS0123abcd=xyz'))
+            self.assertFalse(re.search(page_cache['bypass_cookies'],
+                'has_js=1'))
+
+            lampsible.set_action('laravel')
+            self.assertEqual(lampsible.get_page_cache(), {})
+
+
+class TestFleetNames(unittest.TestCase):
+
+    def test_names_per_host(self):
+        hosts = ['server-1.example.com', 'server-2.example.com']
+        with TemporaryDirectory() as tmp_dir:
+            lampsible = Lampsible(
+                web_user='root',
+                web_host=hosts,
+                action='wordpress',
+                private_data_dir=tmp_dir,
+                history_file=None,
+                email_for_ssl='admin@example.com',
+            )
+            lampsible._set_apache_vars()
+            for host in hosts:
+                self.assertEqual(lampsible.get_server_name(host), host)
+                self.assertEqual(lampsible.get_wordpress_url(host),
+                    'www.{}'.format(host))
+                self.assertEqual(lampsible.get_certbot_domains(host),
+                    [host, 'www.{}'.format(host)])
+            self.assertEqual(lampsible.get_server_name('web-1'),
+                DEFAULT_APACHE_SERVER_NAME)
+
+
+class TestPrivateDataDir(unittest.TestCase):
+
+    def test_removed_when_collected(self):
+        lampsible = Lampsible(
+            web_user='root',
+            web_host='localhost',
+            action='apache',
+            history_file=None,
+        )
+        private_data_dir = lampsible.private_data_dir
+        self.assertTrue(os.path.isdir(private_data_dir))
+        del lampsible
+        gc.collect()
+        self.assertFalse(os.path.exists(private_data_dir))
+
+
+class TestGalaxyCollections(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.lampsible = Lampsible(
+            web_user='root',
+            web_host='localhost',
+            action='apache',
+            private_data_dir=os.path.join(self.tmp_dir.name, 'run'),
+            history_file=None,
+        )
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    def test_collections_paths(self):
+        collection_dir = os.path.join(self.tmp_dir.name, 'ansible_collections',
+            'community', 'mysql')
+        os.makedirs(collection_dir)
+        with open(os.path.join(collection_dir, 'MANIFEST.json'), 'w') as stream:
+            stream.write('{}')
+
+        for path_str in [
+            self.tmp_dir.name,
+            os.path.join(self.tmp_dir.name, 'ansible_collections'),
+        ]:
+            self.assertTrue(self.lampsible._is_galaxy_collection_installed(
+                'community.mysql', [path_str]))
+        self.assertFalse(self.lampsible._is_galaxy_collection_installed(
+            'community.general', [self.tmp_dir.name]))
+
+
+    def test_newest_vendored_collection(self):
+        vendored_dir = os.path.join(self.tmp_dir.name, 'collections')
+        os.makedirs(vendored_dir)
+        for tarball_version in ['9.5.0', '10.2.0', '10.10.1']:
+            open(os.path.join(vendored_dir, 'community-general-{}.tar.gz'.format(
+                tarball_version)), 'w').close()
+
+        with patch('lampsible.lampsible.get_vendored_collections_dir',
+                return_value=vendored_dir):
+            self.assertEqual(
+                os.path.basename(self.lampsible._find_vendored_collection(
+                    'community.general')),
+                'community-general-10.10.1.tar.gz'
+            )
+            self.assertIsNone(self.lampsible._find_vendored_collection(
+                'community.mysql'))
+
+
+class TestRoleHashes(unittest.TestCase):
+
+    def test_ignores_bytecode(self):
+        with TemporaryDirectory() as tmp_dir:
+            lampsible = Lampsible(
+                web_user='root',
+                web_host='localhost',
+                action='apache',
+                private_data_dir=os.path.join(tmp_dir, 'run'),
+                history_file=None,
+            )
+            library_dir = os.path.join(tmp_dir, 'roles', 'example', 'library')
+            os.makedirs(library_dir)
+            with open(os.path.join(library_dir, 'example.py'), 'w') as stream:
+                stream.write('print("example")\n')
+
+            with patch('lampsible.lampsible.find_package_project_dir',
+                    return_value=tmp_dir):
+                role_hashes = lampsible.get_role_hashes({})
+                os.makedirs(os.path.join(library_dir, '__pycache__'))
+                for path_str in [
+                    os.path.join(library_dir, '__pycache__',
+                        'example.cpython-311.pyc'),
+                    os.path.join(library_dir, 'example.pyc'),
+                ]:
+                    with open(path_str, 'wb') as stream:
+                        stream.write(os.urandom(16))
+                self.assertEqual(lampsible.get_role_hashes({}), role_hashes)
+
+
+class TestStream(unittest.TestCase):
+
+    def test_close_cancels(self):
+
+        class EndlessLampsible(Lampsible):
+            # Stands in for a long playbook, which only stops when cancelled.
+            def run(self, event_callback=None, profile=False):
+                self._cancel_requested = False
+                while not self._cancel_requested:
+                    event_callback({'type': 'task'})
+                    sleep(0.01)
+                self.rc = 1
+                return self.rc
+
+        with TemporaryDirectory() as tmp_dir:
+            lampsible = EndlessLampsible(
+                web_user='root',
+                web_host='localhost',
+                action='apache',
+                private_data_dir=tmp_dir,
+                history_file=None,
+            )
+            events = lampsible.stream()
+            next(events)
+            events.close()
+            self.assertEqual(lampsible.rc, 1)
+
+
+class TestArtifactSource(unittest.TestCase):
+
+    def test_wordpress_locale(self):
+        self.assertEqual(
+            get_wordpress_artifact_source('6.7.1', 'pt_BR'),
+            (
+                'wordpress-6.7.1-pt_BR.tar.gz',
+                'https://downloads.wordpress.org/release/pt_BR/wordpress-6.7.1.tar.gz',
+                False,
+                'sha1:https://downloads.wordpress.org/release/pt_BR/wordpress-6.7.1.tar.gz.sha1',
+            )
+        )
+        self.assertEqual(
+            get_wordpress_artifact_source('6.7.1', 'en_US')[1],
+            'https://wordpress.org/wordpress-6.7.1.tar.gz'
+        )
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def test_reuse_verifies_checksum(self):
+        with TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, 'wp-cli.phar')
+            with open(src, 'wb') as stream:
+                stream.write(b'<?php echo 1;')
+            with open(src + '.json', 'w') as stream:
+                json.dump({
+                    'url':     WP_CLI_DOWNLOAD_URL,
+                    'sha256':  sha256(b'<?php echo 1;').hexdigest(),
+                    'size':    13,
+                    'fetched': time(),
+                }, stream)
+
+            cache = ArtifactCache(tmp_dir)
+            self.assertEqual(cache.get('wp-cli.phar', WP_CLI_DOWNLOAD_URL,
+                fetch=False)['src'], src)
+
+            # Same size, different content.
+            with open(src, 'wb') as stream:
+                stream.write(b'<?php echo 2;')
+            self.assertEqual(cache.get('wp-cli.phar', WP_CLI_DOWNLOAD_URL,
+                fetch=False)['src'], '')
+
+
+    def test_no_fetch(self):
+        with TemporaryDirectory() as tmp_dir:
+            with patch('requests.get', side_effect=AssertionError):
+                artifact = ArtifactCache(tmp_dir).get('wp-cli.phar',
+                    WP_CLI_DOWNLOAD_URL, True, WP_CLI_CHECKSUM, fetch=False)
+            self.assertEqual(artifact['src'], '')
+            self.assertEqual(artifact['checksum'], WP_CLI_CHECKSUM)